@@ -0,0 +1,268 @@
+# Oflayn benchmark: hujjat dvigatellari va matn yozish jarayoni (tarmoq/Telegram/bazasiz)
+#   python bench.py engines  [--sections 10,20,30] [--fmt pptx,docx,pdf] [--repeat 5]
+#   python bench.py pipeline [--latency 0.3] [--tps 400] [--runs 8] [--concurrency 4]
+#   python bench.py startup  [--import-budget 7]      # import main: tarmoqsiz, og'ir kutubxonalarsiz, vaqt chegarasi (0 = o'chirilgan)
+#   python bench.py all --save bench_baseline.json      # bazaviy natijani saqlash
+#   python bench.py all --compare bench_baseline.json   # regressiya bo'lsa exit code 1
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+os.chdir(os.path.dirname(os.path.abspath(__file__))) # FONT_PATH nisbiy yo'l
+sys.path.insert(0, os.getcwd())
+
+INFO = {"topic": "Raqamli iqtisodiyot va uning rivojlanish istiqbollari", "student": "Aliyev Vali", "group": "101-guruh",
+        "teacher": "Karimov K.", "edu_place": "Toshkent davlat iqtisodiyot universiteti", "direction": "Iqtisodiyot", "subject": "Makroiqtisodiyot"}
+WORDS = ("iqtisodiyot rivojlanish tizim jarayon tahlil natija samaradorlik innovatsiya texnologiya boshqaruv bozor "
+         "raqamli strategiya ta'lim ilmiy mehnat resurs siyosat islohot investitsiya barqaror o'sish sanoat xizmat").split()
+ENGINE_WORDS = {"pptx": 180, "docx": 800, "pdf": 800} # section_prompt dagi hajmlar
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # Linux: KB
+
+def pct(values, p):
+    s = sorted(values)
+    return s[max(0, min(len(s) - 1, math.ceil(p / 100 * len(s)) - 1))]
+
+def fake_text(rng, words, per_line):
+    # Bo'lim matni: qatorlar/paragraflar, har biri nuqta bilan tugaydi
+    lines, left = [], words
+    while left > 0:
+        n = min(left, per_line); left -= n
+        lines.append(" ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + ".")
+    return "\n".join(lines)
+
+def fixture(sections, words, per_line, seed=1):
+    rng = random.Random(seed)
+    return [{"title": f"{i}. {' '.join(rng.choice(WORDS) for _ in range(4)).capitalize()}", "content": fake_text(rng, words, per_line)}
+            for i in range(1, sections + 1)]
+
+# ==============================================================================
+# DVIGATELLAR (create_presentation / create_document / create_pdf)
+# ==============================================================================
+def engine_case(fmt, sections, design, words, repeat):
+    # Har bir holat yangi jarayonda: peak RSS shu holatga tegishli bo'ladi
+    import main
+    data = fixture(sections, words, 25 if fmt == "pptx" else 90)
+    create = {"pptx": lambda: main.create_presentation(data, INFO, design),
+              "docx": lambda: main.create_document(data, INFO, "Referat"),
+              "pdf": lambda: main.create_pdf(data, INFO, "Referat")}[fmt]
+    def run():
+        # None (masalan, shrift yo'q) tez ishlagan xato yo'l: uni o'lchab bo'lmaydi
+        out = create()
+        if out is None: raise RuntimeError(f"{fmt} yasalmadi (PDF uchun: python main.py fetch-font yoki FONT_PATH)")
+        return out
+    rss0 = peak_rss_mb()
+    t = time.perf_counter(); out = run(); cold = time.perf_counter() - t # Shablon/font keshi ham shu yerda to'ladi
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter(); out = run(); times.append(time.perf_counter() - t)
+    return {"cold_ms": cold * 1000, "p50_ms": pct(times, 50) * 1000, "p99_ms": pct(times, 99) * 1000,
+            "docs_per_s": len(times) / sum(times), "rss_mb": peak_rss_mb(), "rss_delta_mb": peak_rss_mb() - rss0,
+            "size_kb": len(out.getvalue()) / 1024}
+
+def engine_cases(args):
+    import main # Faqat mavzular ro'yxati uchun
+    themes = list(main.PPTX_THEMES) if args.themes == "all" else args.themes.split(",")
+    for fmt in args.fmt.split(","):
+        for n in map(int, args.sections.split(",")):
+            for design in (themes if fmt == "pptx" else ["-"]):
+                yield f"engine:{fmt}:{n}:{design}", (fmt, n, design if fmt == "pptx" else "modern_blue", args.words or ENGINE_WORDS[fmt], args.repeat)
+
+# ==============================================================================
+# MATN YOZISH (generate_full_content + soxta LLM server)
+# ==============================================================================
+def run_stub(port, latency, jitter, tps):
+    # OpenAI/Groq ga o'xshash server: reja va bo'lim so'rovlariga soxta matn, kechikish bilan
+    import uvicorn
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+    app, rng = FastAPI(), random.Random(7)
+
+    def answer(prompt):
+        if m := re.search(r"(\d+) ta slayd", prompt):
+            return json.dumps([f"{i}-slayd: {' '.join(rng.choice(WORDS) for _ in range(3))}" for i in range(1, int(m[1]) + 1)])
+        if m := re.search(r"(\d+) ta bobdan", prompt):
+            return "\n".join(f"{i}. {' '.join(rng.choice(WORDS) for _ in range(4)).capitalize()}" for i in range(1, int(m[1]) + 1))
+        m = re.search(r"(\d+)(?:-(\d+))? so'z", prompt)
+        return fake_text(rng, int(m[2] or m[1]) if m else 200, 40)
+
+    def chunk(model, delta, finish=None, usage=None):
+        body = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+        if usage: body["x_groq"] = {"usage": usage}
+        return f"data: {json.dumps(body)}\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        req = await request.json()
+        text = answer(req["messages"][-1]["content"]); words = text.split(" ")
+        usage = {"prompt_tokens": len(req["messages"][-1]["content"]) // 4, "completion_tokens": len(words), "total_tokens": 0}
+        await asyncio.sleep(max(0, latency + rng.uniform(-jitter, jitter))) # Birinchi token
+        if not req.get("stream"):
+            await asyncio.sleep(len(words) / tps)
+            return JSONResponse({"id": "bench", "object": "chat.completion", "created": 0, "model": req["model"], "usage": usage,
+                                 "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}]})
+        async def stream():
+            for i in range(0, len(words), 20):
+                yield chunk(req["model"], {"content": " ".join(words[i:i + 20]) + " "})
+                await asyncio.sleep(20 / tps)
+            yield chunk(req["model"], {}, "stop", usage)
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="error")
+
+def pipeline_case(doc_type, pages, runs, concurrency):
+    import main
+    sem = asyncio.Semaphore(concurrency)
+    async def one(i):
+        async with sem:
+            t = time.perf_counter()
+            res = await main.generate_full_content(f"Mavzu {i}", pages, doc_type, "-", None)
+            if not res or any(x['content'] == "..." for x in res): raise RuntimeError("LLM javobi chala")
+            return time.perf_counter() - t
+    async def go():
+        t = time.perf_counter()
+        times = await asyncio.gather(*(one(i) for i in range(runs)))
+        await main.close_llm_clients()
+        return times, time.perf_counter() - t
+    times, wall = asyncio.run(go())
+    return {"p50_ms": pct(times, 50) * 1000, "p99_ms": pct(times, 99) * 1000, "docs_per_min": runs / wall * 60, "rss_mb": peak_rss_mb()}
+
+def pipeline_cases(args):
+    for doc_type, lengths in (("taqdimot", args.slides), ("referat", args.pages)):
+        for n in map(int, lengths.split(",")):
+            yield f"pipeline:{doc_type}:{n}:c{args.concurrency}", (doc_type, n, args.runs, args.concurrency)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+def wait_port(port, timeout=30):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            with socket.create_connection(("127.0.0.1", port), 0.2): return
+        except OSError: time.sleep(0.1)
+    raise RuntimeError("Soxta LLM server ishga tushmadi")
+
+# ==============================================================================
+# START (import main: vaqt, xotira, tarmoq va og'ir kutubxonalarsiz)
+# ==============================================================================
+HEAVY_MODULES = ("docx", "pptx", "fpdf", "fontTools", "openai") # Faqat ishlatilganda yuklanishi kerak
+STARTUP_PROBE = """
+import json, resource, socket, sys, time
+calls = []
+def offline(*a, **kw): calls.append(next((repr(x) for x in a if isinstance(x, (str, tuple))), "?")[:60]); raise OSError("import paytida tarmoqqa chiqildi") # Xato yutilsa ham sanaladi
+socket.socket.connect = socket.socket.connect_ex = offline
+socket.create_connection = socket.getaddrinfo = offline
+t = time.perf_counter(); import main; t = time.perf_counter() - t
+print(json.dumps({"s": t, "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "heavy": [m for m in %r if m in sys.modules], "network": calls}))
+"""
+
+# O'lchangan ~5.2 s + zaxira; kechiktirilgan importlardan oldingi 7.2 s ga qaytish shu chegaradan oshadi
+IMPORT_BUDGET = 7.0
+
+def startup_case(repeat, budget):
+    # Har safar yangi interpreter: .pyc keshi issiq, boshqa hech narsa yuklanmagan
+    runs, errors = [], []
+    for _ in range(repeat):
+        p = subprocess.run([sys.executable, "-c", STARTUP_PROBE % (HEAVY_MODULES,)], capture_output=True, text=True)
+        if p.returncode:
+            return {}, [f"import main xato: {p.stderr.strip().splitlines()[-1] if p.stderr.strip() else p.returncode}"]
+        runs.append(json.loads(p.stdout.splitlines()[-1]))
+    times = [r["s"] for r in runs]
+    res = {"p50_ms": pct(times, 50) * 1000, "p99_ms": pct(times, 99) * 1000, "rss_mb": max(r["rss_mb"] for r in runs)}
+    heavy = sorted({m for r in runs for m in r["heavy"]})
+    if heavy: errors.append(f"import paytida yuklangan: {', '.join(heavy)}")
+    if runs[0]["network"]: errors.append(f"import paytida tarmoq: {runs[0]['network'][0]}")
+    if budget and res["p50_ms"] > budget * 1000: errors.append(f"import {res['p50_ms']:,.0f} ms > chegara {budget * 1000:,.0f} ms")
+    return res, errors
+
+# ==============================================================================
+# ISHGA TUSHIRISH, BAZAVIY NATIJALAR
+# ==============================================================================
+def run_isolated(ctx, fn, params):
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as ex: return ex.submit(fn, *params).result()
+
+def show(key, res):
+    print(f"{key:<42} " + "  ".join(f"{k}={v:,.1f}" for k, v in res.items()), flush=True)
+
+def compare(results, baseline, tolerance):
+    # Vaqt (p50) yoki xotira (rss) bazaviydan tolerance dan ko'p oshsa - regressiya
+    bad = []
+    for key, res in results.items():
+        base = baseline.get(key)
+        if not base: continue
+        for metric in ("p50_ms", "rss_mb"):
+            if metric in base and res[metric] > base[metric] * (1 + tolerance):
+                bad.append(f"{key} {metric}: {base[metric]:,.1f} -> {res[metric]:,.1f} (+{(res[metric] / base[metric] - 1) * 100:.0f}%)")
+    return bad
+
+def run_bench():
+    ap = argparse.ArgumentParser(description="EduBot oflayn benchmark")
+    ap.add_argument("suite", choices=["engines", "pipeline", "startup", "all"])
+    ap.add_argument("--fmt", default="pptx,docx,pdf")
+    ap.add_argument("--sections", default="10,20,30")
+    ap.add_argument("--themes", default="all", help="all yoki vergul bilan: modern_blue,elegant_dark")
+    ap.add_argument("--words", type=int, default=0, help="Bo'limdagi so'zlar (0 = pptx 180, docx/pdf 800)")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--slides", default="10,20", help="Taqdimot hajmlari (pipeline)")
+    ap.add_argument("--pages", default="15,30", help="Referat hajmlari (pipeline)")
+    ap.add_argument("--runs", type=int, default=8)
+    ap.add_argument("--concurrency", type=int, default=4, help="Bir vaqtda yoziladigan hujjatlar")
+    ap.add_argument("--latency", type=float, default=0.3, help="LLM birinchi tokengacha, soniya")
+    ap.add_argument("--jitter", type=float, default=0.1)
+    ap.add_argument("--tps", type=float, default=400, help="LLM so'z/soniya (oqim tezligi)")
+    ap.add_argument("--import-budget", type=float, default=float(os.environ.get("IMPORT_BUDGET", IMPORT_BUDGET)), help="import main uchun soniya (0 = tekshirilmaydi)")
+    ap.add_argument("--save", help="Natijani JSON ga yozish")
+    ap.add_argument("--compare", help="Bazaviy JSON bilan solishtirish")
+    ap.add_argument("--tolerance", type=float, default=0.2)
+    args = ap.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    results, stub, failed = {}, None, []
+    try:
+        if args.suite in ("startup", "all"):
+            res, failed = startup_case(args.repeat, args.import_budget)
+            if res: results["startup:import"] = res; show("startup:import", res)
+            for line in failed: print("START:", line)
+        if args.suite in ("engines", "all"):
+            for key, params in engine_cases(args):
+                results[key] = run_isolated(ctx, engine_case, params); show(key, results[key])
+        if args.suite in ("pipeline", "all"):
+            port = free_port()
+            stub = ctx.Process(target=run_stub, args=(port, args.latency, args.jitter, args.tps), daemon=True); stub.start()
+            wait_port(port)
+            # Ishchi jarayonlar main.py ni shu sozlamalar bilan import qiladi
+            os.environ.update(GROQ_KEYS="bench-key-0000", GROQ_BASE_URL=f"http://127.0.0.1:{port}/v1")
+            for key, params in pipeline_cases(args):
+                results[key] = run_isolated(ctx, pipeline_case, params); show(key, results[key])
+    finally:
+        if stub: stub.terminate()
+
+    if args.save:
+        with open(args.save, "w") as f: json.dump(results, f, indent=1, sort_keys=True)
+        print(f"Saqlandi: {args.save}")
+    if args.compare:
+        with open(args.compare) as f: bad = compare(results, json.load(f), args.tolerance)
+        for line in bad: print("REGRESSIYA:", line)
+        if bad: sys.exit(1)
+        print(f"Regressiya yo'q (chegara +{args.tolerance * 100:.0f}%)")
+    if failed: sys.exit(1)
+
+if __name__ == "__main__":
+    run_bench()
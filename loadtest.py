@@ -0,0 +1,250 @@
+# Yuklama testi: soxta Telegram yangilanishlari haqiqiy Dispatcher/router orqali o'tkaziladi.
+# Bot API - jarayon ichidagi soxta sessiya, Groq - bench.py dagi soxta server, Postgres - haqiqiy.
+# FAQAT SINOV BAZASIDA: test navbatdagi barcha ishlarni oladi va oxirida soxta userlarni o'chiradi. Baza avval belgilanadi,
+# belgisiz bazada test ishga tushmaydi:
+#   psql "$DATABASE_URL" -c "CREATE TABLE loadtest_marker ()"
+#   DATABASE_URL=postgresql://... python loadtest.py --users 200 --rate 5 --think 0.5
+# Har bir virtual talaba: /start -> menyu -> mavzu -> reja (skip) -> ... -> dizayn/format -> len_ -> fayl kutiladi.
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+
+import asyncpg
+import bench
+from aiogram import Bot, types
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import MessageId, User
+
+UID_BASE = -1_000_000_000_000 # Soxta userlar shu oraliqda (oxirida tozalanadi): haqiqiy Telegram user id manfiy bo'lmaydi
+TEST_DB_MARKER = "loadtest_marker" # Shu jadval bor bazagina sinov bazasi hisoblanadi
+BOT_ID = 123456
+
+class FakeSession(BaseSession):
+    # Bot API o'rniga: kechikish, ixtiyoriy 429 va har bir chatga ketgan xabarlarni yozib boradi
+    def __init__(self, latency, retry_after_rate, on_message):
+        super().__init__()
+        self.latency, self.retry_after_rate, self.on_message = latency, retry_after_rate, on_message
+        self.ids = itertools.count(1)
+        self.calls, self.injected_429 = Counter(), 0
+        self.markups = {} # chat_id -> oxirgi inline tugmalar (callback_data)
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__; self.calls[name] += 1
+        if self.latency: await asyncio.sleep(random.expovariate(1 / self.latency))
+        if self.retry_after_rate and random.random() < self.retry_after_rate:
+            self.injected_429 += 1
+            raise TelegramRetryAfter(method=method, message="Too Many Requests: retry after 1", retry_after=1)
+        chat_id = getattr(method, "chat_id", None)
+        markup = getattr(method, "reply_markup", None)
+        if chat_id is not None and hasattr(markup, "inline_keyboard"):
+            self.markups[chat_id] = [b.callback_data for row in markup.inline_keyboard for b in row if b.callback_data]
+        if chat_id is not None: self.on_message(chat_id, name, getattr(method, "text", None) or getattr(method, "caption", None) or "")
+        returning = method.__returning__
+        if returning is bool: result = True
+        elif returning is MessageId: result = {"message_id": next(self.ids)}
+        elif returning is User: result = {"id": BOT_ID, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        else:
+            n = next(self.ids)
+            result = {"message_id": n, "date": int(time.time()), "chat": {"id": chat_id or 0, "type": "private"}, "text": "-"}
+            if name == "SendDocument": result["document"] = {"file_id": f"doc{n}", "file_unique_id": f"u{n}"}
+        return self.check_response(bot, method, 200, json.dumps({"ok": True, "result": result})).result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self): pass
+
+class Stats:
+    def __init__(self):
+        self.handler = defaultdict(list) # qadam -> [soniya]
+        self.handler_errors = Counter()
+        self.loop_lag = []
+        self.jobs = [] # (natija, soniya)
+        self.samples = [] # (faol ishlar, navbat, render navbati)
+        self.outcomes = {} # chat_id -> Future (fayl yoki xato matni)
+
+    def on_message(self, chat_id, method, text):
+        fut = self.outcomes.get(chat_id)
+        if not fut or fut.done(): return
+        plain = re.sub(r"<[^>]+>", "", text).strip()
+        if method == "SendDocument": fut.set_result("done")
+        elif plain.startswith("❌") or "Texnik xatolik" in plain or "navbat juda katta" in plain:
+            fut.set_result(plain.split("\n")[0][:50])
+
+update_ids = itertools.count(1)
+
+def user_json(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"Talaba{uid - UID_BASE}", "username": f"lt{uid - UID_BASE}"}
+
+def message_update(uid, text):
+    return {"update_id": next(update_ids), "message": {
+        "message_id": next(update_ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": user_json(uid), "text": text}}
+
+def callback_update(uid, data):
+    return {"update_id": next(update_ids), "callback_query": {
+        "id": str(next(update_ids)), "from": user_json(uid), "chat_instance": str(uid), "data": data,
+        "message": {"message_id": next(update_ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                    "from": {"id": BOT_ID, "is_bot": True, "first_name": "LoadTest"}, "text": "-"}}}
+
+async def student(i, bot, dp, session, stats, args):
+    # Bitta talabaning to'liq buyurtma yo'li
+    uid = UID_BASE + i
+    rng = random.Random(i)
+    presentation = rng.random() < args.mix
+
+    async def step(name, update):
+        if args.think: await asyncio.sleep(rng.expovariate(1 / args.think))
+        t = time.perf_counter()
+        try: await dp.feed_update(bot, types.Update.model_validate(update, context={"bot": bot}))
+        except Exception as e:
+            stats.handler_errors[f"{name}: {type(e).__name__}"] += 1
+        finally: stats.handler[name].append(time.perf_counter() - t)
+
+    def pick(prefix):
+        options = [d for d in session.markups.get(uid, []) if d.startswith(prefix)]
+        return rng.choice(options) if options else None
+
+    topic = f"Mavzu {i % args.topics}: " + " ".join(rng.choice(bench.WORDS) for _ in range(3))
+    await step("start", message_update(uid, "/start"))
+    await step("menu", message_update(uid, "📊 Taqdimot" if presentation else rng.choice(["📑 Referat", "📝 Mustaqil ish"])))
+    await step("topic", message_update(uid, topic))
+    await step("plan", callback_update(uid, "skip"))
+    await step("student", message_update(uid, f"Talaba {i}"))
+    for name in ("uni", "fac", "grp"): await step(name, callback_update(uid, "skip"))
+    await step("subject", message_update(uid, "Iqtisodiyot"))
+    await step("teacher", message_update(uid, "Karimov K."))
+    choice = pick("d_" if presentation else "fmt_")
+    if not choice:
+        stats.jobs.append(("tugma topilmadi", 0)); return
+    await step("design" if presentation else "format", callback_update(uid, choice))
+    length = pick("len_")
+    if not length:
+        stats.jobs.append(("tugma topilmadi", 0)); return
+    fut = stats.outcomes[uid] = asyncio.get_running_loop().create_future()
+    t = time.perf_counter()
+    await step("len", callback_update(uid, length))
+    try: res = await asyncio.wait_for(fut, args.job_timeout)
+    except asyncio.TimeoutError: res = "timeout"
+    stats.jobs.append((res, time.perf_counter() - t))
+
+async def loop_lag(stats, interval=0.05):
+    while True:
+        t = time.perf_counter(); await asyncio.sleep(interval)
+        stats.loop_lag.append(time.perf_counter() - t - interval)
+
+async def sampler(stats):
+    while True:
+        try: queued = await main.queued_jobs_count()
+        except Exception: queued = -1
+        stats.samples.append((len(main.active_jobs), queued, main.render_pending))
+        await asyncio.sleep(1)
+
+async def cleanup(lo, hi):
+    async with main.pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("DELETE FROM reservations WHERE user_id BETWEEN $1 AND $2", lo, hi)
+            await conn.execute("DELETE FROM jobs WHERE user_id BETWEEN $1 AND $2", lo, hi)
+            for table in ("history", "transactions", "users"):
+                await conn.execute(f"DELETE FROM {table} WHERE user_id BETWEEN $1 AND $2", lo, hi)
+            await conn.execute("DELETE FROM fsm_state WHERE split_part(key, ':', 3)::bigint BETWEEN $1 AND $2", lo, hi)
+
+def ms(values, p): return bench.pct(values, p) * 1000 if values else 0
+
+def report(stats, session, wall, args):
+    print(f"\n=== {args.users} talaba, {args.rate}/s, {wall:.1f}s ===")
+    print(f"{'Handler':<10} {'soni':>6} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, vals in stats.handler.items():
+        print(f"{name:<10} {len(vals):>6} {ms(vals, 50):>9.1f} {ms(vals, 99):>9.1f} {max(vals) * 1000:>9.1f}")
+    for err, n in stats.handler_errors.most_common(): print(f"  xato: {err} x{n}")
+    print(f"Event loop kechikishi: p50 {ms(stats.loop_lag, 50):.1f} ms, p99 {ms(stats.loop_lag, 99):.1f} ms, max {max(stats.loop_lag, default=0) * 1000:.1f} ms")
+    done = [t for r, t in stats.jobs if r == "done"]
+    outcomes = Counter(r for r, _ in stats.jobs)
+    print(f"Ishlar: {len(stats.jobs)} ta, tayyor {len(done)} ({len(done) / max(len(stats.jobs), 1) * 100:.0f}%), "
+          f"p50 {bench.pct(done, 50) if done else 0:.1f}s, p99 {bench.pct(done, 99) if done else 0:.1f}s, {len(done) / wall * 60:.1f} hujjat/daq")
+    for res, n in outcomes.most_common():
+        if res != "done": print(f"  muvaffaqiyatsiz: {res} x{n}")
+    if stats.samples:
+        active, queued, render = zip(*stats.samples)
+        print(f"Bir vaqtdagi ishlar: max {max(active)} (o'rtacha {sum(active) / len(active):.1f}), navbat max {max(queued)}, render navbati max {max(render)}")
+    print(f"Bot API: {sum(session.calls.values())} so'rov, soxta 429: {session.injected_429}, limitlar: {main.send_scheduler.snapshot()}")
+    return {"handler": {k: {"n": len(v), "p50_ms": ms(v, 50), "p99_ms": ms(v, 99)} for k, v in stats.handler.items()},
+            "handler_errors": dict(stats.handler_errors), "loop_lag_p99_ms": ms(stats.loop_lag, 99),
+            "jobs": dict(outcomes), "job_p50_s": bench.pct(done, 50) if done else None, "job_p99_s": bench.pct(done, 99) if done else None,
+            "docs_per_min": len(done) / wall * 60, "max_active_jobs": max((s[0] for s in stats.samples), default=0)}
+
+async def is_test_db():
+    # Migratsiyalardan ham oldin tekshiriladi: belgisiz bazaga umuman tegilmaydi
+    conn = await asyncpg.connect(os.environ["DATABASE_URL"])
+    try: return await conn.fetchval("SELECT to_regclass($1)", TEST_DB_MARKER) is not None
+    finally: await conn.close()
+
+async def run(args):
+    if not await is_test_db():
+        sys.exit(f"Bu baza sinov bazasi deb belgilanmagan ({TEST_DB_MARKER} jadvali yo'q): test haqiqiy ishlarni oladi va userlarni o'chiradi")
+    await main.init_db()
+    if not main.pool: sys.exit("Postgres ga ulanib bo'lmadi (DATABASE_URL)")
+    stats = Stats()
+    session = FakeSession(args.tg_latency, args.tg_429, stats.on_message)
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=session)
+    bot.session.middleware(main.send_scheduler)
+    dp = main.make_dispatcher()
+    tasks, listener = await main.start_job_workers(bot, main.JOB_WORKERS)
+    monitors = [asyncio.create_task(loop_lag(stats)), asyncio.create_task(sampler(stats))]
+    users, t0 = [], time.perf_counter()
+    try:
+        for i in range(args.users): # Puasson oqimi: o'rtacha args.rate talaba/soniya
+            users.append(asyncio.create_task(student(i, bot, dp, session, stats, args)))
+            await asyncio.sleep(random.expovariate(args.rate))
+        await asyncio.gather(*users)
+    finally:
+        wall = time.perf_counter() - t0
+        for t in users + monitors: t.cancel()
+        await main.stop_job_workers(tasks, listener)
+        for uid in list(main.prefetches): main.cancel_prefetch(uid)
+        result = report(stats, session, wall, args)
+        if not args.keep: await cleanup(UID_BASE, UID_BASE + args.users)
+        await main.close_llm_clients(); main.shutdown_render_pool(); await main.pool.close()
+    if args.json:
+        with open(args.json, "w") as f: json.dump(result, f, indent=1)
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="EduBot yuklama testi")
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--rate", type=float, default=2, help="Yangi talabalar/soniya")
+    ap.add_argument("--think", type=float, default=0.5, help="Qadamlar orasidagi o'rtacha pauza, soniya")
+    ap.add_argument("--mix", type=float, default=0.5, help="Taqdimot ulushi (qolgani referat/mustaqil ish)")
+    ap.add_argument("--topics", type=int, default=10**9, help="Turli mavzular soni (kichik bo'lsa kesh ishlaydi)")
+    ap.add_argument("--job-workers", type=int, default=int(os.environ.get("JOB_WORKERS", 2)))
+    ap.add_argument("--job-timeout", type=float, default=600)
+    ap.add_argument("--tg-latency", type=float, default=0.05, help="Bot API o'rtacha javob vaqti")
+    ap.add_argument("--tg-429", type=float, default=0, help="Soxta 429 ehtimoli")
+    ap.add_argument("--llm-latency", type=float, default=0.5)
+    ap.add_argument("--llm-tps", type=float, default=400, help="LLM so'z/soniya")
+    ap.add_argument("--keep", action="store_true", help="Soxta userlar bazada qoldirilsin")
+    ap.add_argument("--json", help="Natijani JSON ga yozish")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.environ.get("DATABASE_URL"): sys.exit("DATABASE_URL kerak (mahalliy Postgres)")
+    ctx = multiprocessing.get_context("spawn")
+    port = bench.free_port()
+    stub = ctx.Process(target=bench.run_stub, args=(port, args.llm_latency, 0.1, args.llm_tps), daemon=True); stub.start()
+    # main.py import qilinishidan oldin: soxta LLM va bot tokeni
+    os.environ.update(GROQ_KEYS="loadtest-0000", GROQ_BASE_URL=f"http://127.0.0.1:{port}/v1", BOT_TOKEN=f"{BOT_ID}:LOADTEST",
+                      JOB_WORKERS=str(args.job_workers), BOT_MODE="polling")
+    import main
+    try:
+        bench.wait_port(port)
+        asyncio.run(run(args))
+    except KeyboardInterrupt: pass
+    finally: stub.terminate()
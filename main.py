@@ -4,11 +4,25 @@ import sys
 import json
 import re
 import os
-import requests
 import csv
-from io import BytesIO, StringIO
-from datetime import datetime
-from itertools import cycle
+import hashlib
+import hmac
+from contextlib import asynccontextmanager
+import heapq
+import itertools
+import contextvars
+import random
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO, TextIOWrapper
+import gzip
+import tempfile
+from datetime import datetime, timedelta
+import time
+import copy
+import functools
 
 # --- ENV SOZLAMALARI ---
 try:
@@ -17,40 +31,97 @@ try:
 except ImportError:
     pass
 
-from aiogram import Bot, Dispatcher, F, types, Router
+from aiogram import Bot, Dispatcher, F, types, Router, BaseMiddleware
 from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton,
-    BufferedInputFile, CallbackQuery
+    FSInputFile, CallbackQuery, InputFile
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
 from aiogram.utils.deep_linking import create_start_link
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import (
+    SendMessage, SendPhoto, SendDocument, SendMediaGroup, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageCaption, EditMessageReplyMarkup
+)
 
 # --- WEB SERVER (RENDER UCHUN) ---
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, Response
 import uvicorn
 import asyncpg
-
-app = FastAPI()
+from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
+
+# Webhook rejimi: Telegram yangilanishlarni shu FastAPI ilovasiga yuboradi
+BOT_MODE = os.environ.get("BOT_MODE", "polling") # polling | webhook
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "") # https://example.com
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", 1)) # uvicorn jarayonlari
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_CONSUMERS = int(os.environ.get("UPDATE_CONSUMERS", 32))
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0)) # Alohida ishchi (python main.py worker) /metrics ni shu portda beradi
+
+update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+webhook_runtime = {} # bot, dp, vazifalar (faqat webhook rejimida)
+
+@asynccontextmanager
+async def lifespan(app):
+    if BOT_MODE != "webhook": # Polling rejimida server faqat health-check uchun
+        yield; return
+    await start_webhook_runtime()
+    try: yield
+    finally: await stop_webhook_runtime()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.head("/")
-@app.get("/", response_class=HTMLResponse)
+@app.get("/")
 async def home():
-    return "<h1>EduBot Pro Running...</h1>"
-
-async def run_web_server():
-    port = int(os.environ.get("PORT", 8000))
-    config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="error")
+    # Health-check: baza ulanishlari, render va ishchilar holati
+    db = {"size": pool.get_size(), "idle": pool.get_idle_size(), "max": pool.get_max_size()} if pool else None
+    return {
+        "status": "ok" if db else "no_db", "mode": BOT_MODE, "db": db,
+        "render": {"pending": render_pending, "busy": render_busy(), "pool": render_pool is not None, "stream_pool": stream_pool is not None},
+        "workers": {"configured": JOB_WORKERS, "active_jobs": len(active_jobs)},
+        "update_queue": update_queue.qsize(), "send_queue": len(send_scheduler.waiters),
+    }
+
+@app.get("/metrics")
+async def metrics():
+    if pool:
+        try: JOBS_QUEUED.set(await queued_jobs_count())
+        except Exception as e: report_error("metrics", f"Metrics error: {e}")
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET): return Response(status_code=403)
+    if "dp" not in webhook_runtime: return Response(status_code=503)
+    try: update_queue.put_nowait(await request.json())
+    except asyncio.QueueFull: return Response(status_code=503) # Telegram keyinroq qayta yuboradi
+    return Response()
+
+@app.get("/stats/cache")
+async def cache_stats_view():
+    return {**cache_stats, "local_size": len(local_cache)}
+
+@app.get("/stats/send")
+async def send_stats_view():
+    return send_scheduler.snapshot()
+
+async def run_web_server(port=None, lifespan="auto"):
+    port = port or int(os.environ.get("PORT", 8000))
+    config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="error", lifespan=lifespan)
     server = uvicorn.Server(config)
     await server.serve()
 
 # --- KONFIGURATSIYA ---
-from openai import AsyncOpenAI
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_ID = int(os.environ.get("ADMIN_ID", 0))
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME", "admin")
@@ -59,159 +130,596 @@ DATABASE_URL = os.environ.get("DATABASE_URL")
 REFERRAL_BONUS = 10000
 
 groq_keys_str = os.environ.get("GROQ_KEYS", "")
-GROQ_API_KEYS = groq_keys_str.split(",") if "," in groq_keys_str else [groq_keys_str]
-api_key_cycle = cycle([k for k in GROQ_API_KEYS if k])
+GROQ_API_KEYS = [k.strip() for k in groq_keys_str.split(",") if k.strip()]
 GROQ_MODELS = ["llama-3.3-70b-versatile", "llama-3.1-70b-versatile"]
-
+GROQ_BASE_URL = os.environ.get("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 90))
+LLM_MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", 6))
+LLM_COOLDOWN = int(os.environ.get("LLM_COOLDOWN", 20)) # Xato bergan kalit necha soniya dam oladi
+LLM_JOB_CONCURRENCY = int(os.environ.get("LLM_JOB_CONCURRENCY", 4)) # Bitta hujjat uchun parallel so'rovlar
+LLM_GLOBAL_CONCURRENCY = int(os.environ.get("LLM_GLOBAL_CONCURRENCY", 12)) # Butun bot bo'yicha
+
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 2)) # Hujjat yasovchi jarayonlar soni
+RENDER_MAX_QUEUE = int(os.environ.get("RENDER_MAX_QUEUE", 8)) # Navbatda kutishi mumkin bo'lgan hujjatlar
+RENDER_STREAM = os.environ.get("RENDER_STREAM", "1") == "1" # Hujjatni bo'limlar yozilayotganda yig'ish
+RENDER_STREAM_IDLE = int(os.environ.get("RENDER_STREAM_IDLE", 900)) # Bo'lim kelmasa, ishchi jarayon shuncha kutib to'xtaydi
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2)) # Shu jarayondagi ishchilar (0 = faqat bot)
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 5))
+JOB_STALE_SECONDS = int(os.environ.get("JOB_STALE_SECONDS", 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 2))
+JOB_MAX_QUEUED = int(os.environ.get("JOB_MAX_QUEUED", 200)) # Navbat to'lsa yangi buyurtma olinmaydi
+
+CACHE_TTL_DAYS = float(os.environ.get("CACHE_TTL_DAYS", 14)) # Tayyor matnlar keshi
+CACHE_MAX_ROWS = int(os.environ.get("CACHE_MAX_ROWS", 5000))
+CACHE_LOCAL_SIZE = int(os.environ.get("CACHE_LOCAL_SIZE", 64))
+CACHE_VARIANTS = int(os.environ.get("CACHE_VARIANTS", 1)) # >1: bir mavzu uchun bir nechta xil variant saqlanadi
+
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 3)) # Holat xabari necha soniyada yangilanadi
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", 30)) # Shu jarayondan sekundiga xabarlar
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", 1)) # Bitta chatga sekundiga
+TG_CHAT_BURST = int(os.environ.get("TG_CHAT_BURST", 3))
+TG_MAX_RETRIES = int(os.environ.get("TG_MAX_RETRIES", 3))
+BC_BATCH = int(os.environ.get("BC_BATCH", 500)) # Tarqatish: bir partiyadagi userlar
+BC_CONCURRENCY = int(os.environ.get("BC_CONCURRENCY", 30))
+BC_REPORT_INTERVAL = int(os.environ.get("BC_REPORT_INTERVAL", 20))
+BC_STALE_SECONDS = int(os.environ.get("BC_STALE_SECONDS", 120))
+FSM_CACHE_TTL = float(os.environ.get("FSM_CACHE_TTL", 1 if BOT_MODE == "webhook" else 300)) # Bir nechta jarayonda qisqa bo'lishi kerak
+FSM_STATE_TTL_HOURS = float(os.environ.get("FSM_STATE_TTL_HOURS", 48)) # Tashlab ketilgan anketalar o'chiriladi
+STATS_REFRESH_DAYS = int(os.environ.get("STATS_REFRESH_DAYS", 2)) # Har safar qayta hisoblanadigan kunlar
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 30))
+PREFETCH_ENABLED = os.environ.get("PREFETCH", "1") == "1" # Anketa to'ldirilayotganda reja oldindan yoziladi
+PREFETCH_SECTIONS = int(os.environ.get("PREFETCH_SECTIONS", 2))
+PREFETCH_TIMEOUT = int(os.environ.get("PREFETCH_TIMEOUT", 180))
+PREFETCH_TTL = int(os.environ.get("PREFETCH_TTL", 900))
+
+DOC_LENGTHS = {"taqdimot": [10, 15, 20], "referat": [15, 20, 30]}
 DEFAULT_PRICES = {
     "pptx_10": 5000, "pptx_15": 7000, "pptx_20": 10000,
     "docx_15": 5000, "docx_20": 7000, "docx_30": 12000
 }
 
 # --- KUTUBXONALAR ---
-from docx import Document
-from docx.shared import Pt, Cm
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from pptx import Presentation
-from pptx.util import Pt as PptxPt, Inches as PptxInches
-from pptx.dml.color import RGBColor as PptxRGB
-from pptx.enum.shapes import MSO_SHAPE
-from pptx.enum.text import PP_ALIGN
-from fpdf import FPDF
-
-# FONTNI TEKSHIRISH (PDF UCHUN)
-FONT_PATH = "DejaVuSans.ttf"
-def check_font():
-    if not os.path.exists(FONT_PATH):
-        try:
-            url = "https://raw.githubusercontent.com/coreybutler/fonts/master/ttf/DejaVuSans.ttf"
-            r = requests.get(url, timeout=30)
-            with open(FONT_PATH, 'wb') as f: f.write(r.content)
-            print("✅ Font yuklandi!")
-        except: pass
-check_font()
+# Og'ir kutubxonalar import paytida yuklanmaydi: hujjat dvigatellari faqat hujjat yasaladigan
+# jarayonda (render ishchilari), LLM klienti birinchi kerak bo'lganda yoki fonda oldindan
+@functools.lru_cache(maxsize=None)
+def load_engines():
+    global Document, Pt, Cm, WD_ALIGN_PARAGRAPH, Presentation, PptxPt, PptxInches, PptxRGB, MSO_SHAPE, parse_xml, nsdecls, qn, FPDF, SubsetMap, ttLib
+    from docx import Document
+    from docx.shared import Pt, Cm
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from pptx import Presentation
+    from pptx.util import Pt as PptxPt, Inches as PptxInches
+    from pptx.dml.color import RGBColor as PptxRGB
+    from pptx.enum.shapes import MSO_SHAPE
+    from pptx.oxml import parse_xml
+    from pptx.oxml.ns import nsdecls, qn
+    from fpdf import FPDF
+    from fpdf.fonts import SubsetMap
+    from fontTools import ttLib
+
+@functools.lru_cache(maxsize=None)
+def load_llm():
+    global AsyncOpenAI, RateLimitError, BadRequestError, AuthenticationError, PermissionDeniedError, NotFoundError
+    from openai import (
+        AsyncOpenAI, RateLimitError, BadRequestError,
+        AuthenticationError, PermissionDeniedError, NotFoundError
+    )
+
+# FONT (PDF UCHUN): FONT_PATH, joriy papka, main.py yonida yoki tizim shriftlari. Import paytida tarmoqqa chiqilmaydi
+FONT_URL = "https://raw.githubusercontent.com/coreybutler/fonts/master/ttf/DejaVuSans.ttf"
+FONT_CANDIDATES = ["DejaVuSans.ttf", os.path.join(os.path.dirname(os.path.abspath(__file__)), "DejaVuSans.ttf"),
+                   "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/dejavu/DejaVuSans.ttf", "/usr/share/fonts/TTF/DejaVuSans.ttf"]
+FONT_PATH = os.environ.get("FONT_PATH") or next((p for p in FONT_CANDIDATES if os.path.exists(p)), FONT_CANDIDATES[1])
+
+def fetch_font():
+    # Build/deploy bosqichida bir marta: python main.py fetch-font
+    if os.path.exists(FONT_PATH): return print(f"✅ Font bor: {FONT_PATH}")
+    from urllib.request import urlopen
+    with urlopen(FONT_URL, timeout=30) as r: data = r.read()
+    with open(FONT_PATH + ".tmp", 'wb') as f: f.write(data)
+    os.replace(FONT_PATH + ".tmp", FONT_PATH) # Chala yozilgan fayl qolmaydi
+    print(f"✅ Font yuklandi: {FONT_PATH}")
+
+# ==============================================================================
+# METRIKALAR (PROMETHEUS, /metrics)
+# ==============================================================================
+# Qiymatlar jarayon ichida saqlanadi: WEB_WORKERS > 1 bo'lsa har jarayon o'zinikini ko'rsatadi
+LLM_SECONDS = Histogram("edubot_llm_request_seconds", "LLM so'rovi davomiyligi", ["key", "model", "outcome"],
+                        buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 90, 120))
+LLM_TOKENS = Counter("edubot_llm_tokens_total", "Sarflangan tokenlar", ["key", "model", "kind"])
+RENDER_SECONDS = Histogram("edubot_render_seconds", "Fayl yasash vaqti (full - to'liq, stream - oxirgi bo'limdan keyin)", ["fmt", "mode"],
+                           buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+TG_SECONDS = Histogram("edubot_telegram_request_seconds", "Bot API so'rovi davomiyligi", ["method"],
+                       buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+TG_WAIT_SECONDS = Histogram("edubot_telegram_wait_seconds", "Limitlar tufayli kutish", buckets=(0.01, 0.1, 0.5, 1, 2, 5, 10, 30))
+TG_RETRY_AFTER = Counter("edubot_telegram_retry_after_total", "Telegram 429 javoblari", ["method"])
+TG_ERRORS = Counter("edubot_telegram_errors_total", "Bot API xatolari", ["method"])
+DB_POOL_WAIT = Histogram("edubot_db_pool_wait_seconds", "Bazadan ulanish olishni kutish", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+DB_QUERY_SECONDS = Histogram("edubot_db_query_seconds", "SQL so'rov davomiyligi", ["op"],
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5))
+JOB_SECONDS = Histogram("edubot_job_seconds", "Buyurtmadan (generate) tayyor faylgacha", ["fmt", "status"],
+                        buckets=(5, 10, 20, 30, 60, 90, 120, 180, 300, 600, 1200))
+JOB_STAGE_SECONDS = Histogram("edubot_job_stage_seconds", "Ish bosqichlari: queue, content, render, send", ["stage", "fmt"],
+                              buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600))
+JOBS_QUEUED = Gauge("edubot_jobs_queued", "Navbatdagi ishlar (bazada)")
+# Qolganlari o'qilayotgan paytda hisoblanadi
+Gauge("edubot_jobs_active", "Shu jarayonda bajarilayotgan ishlar").set_function(lambda: len(active_jobs))
+Gauge("edubot_render_pending", "Render navbati (shu jarayon)").set_function(lambda: render_pending)
+Gauge("edubot_update_queue", "Webhook yangilanishlari navbati").set_function(lambda: update_queue.qsize())
+Gauge("edubot_telegram_send_queue", "Yuborish navbatida kutayotganlar").set_function(lambda: len(send_scheduler.waiters))
+FILE_REUSE = Counter("edubot_file_reuse_total", "Tayyor hujjat file_id orqali: hit, miss, stale", ["result"])
+ERRORS = Counter("edubot_errors_total", "Ushlangan xatolar", ["where"])
+
+def report_error(where, text):
+    # Xato logga yoziladi va hisoblanadi
+    ERRORS.labels(where).inc()
+    print(text)
 
 # ==============================================================================
 # MA'LUMOTLAR BAZASI (DATABASE)
 # ==============================================================================
 pool = None
 
+class MeteredConnection(asyncpg.Connection):
+    # So'rovlar vaqtini o'lchaydi (fetchval/fetchrow ichkarida bir-birini chaqirmaydi: ikki marta sanalmaydi)
+    async def execute(self, *a, **kw):
+        with DB_QUERY_SECONDS.labels("execute").time(): return await super().execute(*a, **kw)
+    async def executemany(self, *a, **kw):
+        with DB_QUERY_SECONDS.labels("executemany").time(): return await super().executemany(*a, **kw)
+    async def fetch(self, *a, **kw):
+        with DB_QUERY_SECONDS.labels("fetch").time(): return await super().fetch(*a, **kw)
+    async def fetchrow(self, *a, **kw):
+        with DB_QUERY_SECONDS.labels("fetchrow").time(): return await super().fetchrow(*a, **kw)
+    async def fetchval(self, *a, **kw):
+        with DB_QUERY_SECONDS.labels("fetchval").time(): return await super().fetchval(*a, **kw)
+
+class MeteredPool:
+    # asyncpg.Pool ustidan qobiq: pool.acquire() dagi kutish (hamma ulanishlar band bo'lsa) o'lchanadi.
+    # Faqat ochiq API ishlatiladi; qolgan metodlar (close, get_size, ...) to'g'ridan-to'g'ri poolga o'tadi
+    def __init__(self, pool): self.pool = pool
+    def __getattr__(self, name): return getattr(self.pool, name)
+
+    @asynccontextmanager
+    async def acquire(self, timeout=None):
+        with DB_POOL_WAIT.time(): conn = await self.pool.acquire(timeout=timeout)
+        try: yield conn
+        finally: await self.pool.release(conn)
+
+async def make_pool(dsn, min_size, max_size, **kw):
+    return MeteredPool(await asyncpg.create_pool(dsn, min_size=min_size, max_size=max_size, connection_class=MeteredConnection, **kw))
+
+async def init_conn(conn):
+    # JSONB ustunlar python dict sifatida o'qiladi/yoziladi
+    await conn.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+# Sxema migratsiyalari: har biri bir marta, versiya tartibida bajariladi (schema_version jadvali)
+MIGRATIONS = [
+    (1, "boshlang'ich sxema", """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY, username TEXT, full_name TEXT,
+            balance INTEGER DEFAULT 0,
+            free_pptx INTEGER DEFAULT 2, free_docx INTEGER DEFAULT 2, free_pdf INTEGER DEFAULT 2,
+            referral_id BIGINT DEFAULT 0, invited_count INTEGER DEFAULT 0,
+            is_blocked INTEGER DEFAULT 0, joined_date TEXT
+        );
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked INTEGER DEFAULT 0;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_id BIGINT DEFAULT 0;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS invited_count INTEGER DEFAULT 0;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS free_pdf INTEGER DEFAULT 2;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS bot_blocked INTEGER DEFAULT 0; -- User botni bloklagan
+
+        CREATE TABLE IF NOT EXISTS history (
+            id SERIAL PRIMARY KEY, user_id BIGINT,
+            doc_type TEXT, topic TEXT, pages INTEGER,
+            student TEXT, uni TEXT, faculty TEXT, grp TEXT, subject TEXT, teacher TEXT,
+            date TEXT
+        );
+        ALTER TABLE history ADD COLUMN IF NOT EXISTS student TEXT DEFAULT '-';
+        ALTER TABLE history ADD COLUMN IF NOT EXISTS uni TEXT DEFAULT '-';
+        ALTER TABLE history ADD COLUMN IF NOT EXISTS faculty TEXT DEFAULT '-';
+        ALTER TABLE history ADD COLUMN IF NOT EXISTS grp TEXT DEFAULT '-';
+        ALTER TABLE history ADD COLUMN IF NOT EXISTS subject TEXT DEFAULT '-';
+        ALTER TABLE history ADD COLUMN IF NOT EXISTS teacher TEXT DEFAULT '-';
+
+        CREATE TABLE IF NOT EXISTS transactions (id SERIAL PRIMARY KEY, user_id BIGINT, amount INTEGER, date TEXT, type TEXT);
+        CREATE TABLE IF NOT EXISTS prices (key TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS admins (user_id BIGINT PRIMARY KEY, added_date TEXT);
+
+        -- Navbat (generatsiya ishlari)
+        CREATE TABLE IF NOT EXISTS jobs (
+            id SERIAL PRIMARY KEY, user_id BIGINT, chat_id BIGINT, status_msg_id BIGINT,
+            payload JSONB, status TEXT DEFAULT 'queued', attempts INTEGER DEFAULT 0, error TEXT,
+            created_at TIMESTAMPTZ DEFAULT now(), updated_at TIMESTAMPTZ DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS jobs_queued_idx ON jobs (id) WHERE status = 'queued';
+        DROP INDEX IF EXISTS jobs_running_idx;
+
+        -- Band qilingan to'lovlar: ish boshlanganda ushlab qolinadi, tugagach yechiladi yoki qaytariladi
+        CREATE TABLE IF NOT EXISTS reservations (
+            job_id INTEGER PRIMARY KEY, user_id BIGINT, kind TEXT, amount INTEGER, status TEXT DEFAULT 'held',
+            created_at TIMESTAMPTZ DEFAULT now(), updated_at TIMESTAMPTZ DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS reservations_held_idx ON reservations (user_id) WHERE status = 'held';
+
+        -- Tayyor matnlar keshi
+        CREATE TABLE IF NOT EXISTS content_cache (
+            key TEXT, variant INTEGER, data JSONB, hits INTEGER DEFAULT 0,
+            created_at TIMESTAMPTZ DEFAULT now(), last_hit TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (key, variant)
+        );
+        CREATE INDEX IF NOT EXISTS content_cache_last_hit_idx ON content_cache (last_hit);
+
+        -- FSM holatlari (anketalar) - barcha jarayonlar uchun umumiy
+        CREATE TABLE IF NOT EXISTS fsm_state (key TEXT PRIMARY KEY, state TEXT, data JSONB DEFAULT '{}', updated_at TIMESTAMPTZ DEFAULT now());
+        CREATE INDEX IF NOT EXISTS fsm_state_updated_idx ON fsm_state (updated_at);
+
+        -- Tarqatishlar (reklama) va ularning kursori
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY, admin_id BIGINT, from_chat_id BIGINT, message_id BIGINT, report_msg_id BIGINT,
+            status TEXT DEFAULT 'running', owner TEXT, last_uid BIGINT DEFAULT 0, total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, blocked INTEGER DEFAULT 0,
+            created_at TIMESTAMPTZ DEFAULT now(), updated_at TIMESTAMPTZ DEFAULT now()
+        );
+
+        -- Narxlar/adminlar o'zgarsa (qo'lda SQL bilan ham) barcha jarayonlar keshini yangilaydi
+        CREATE OR REPLACE FUNCTION notify_settings_changed() RETURNS trigger AS $$
+        BEGIN PERFORM pg_notify('settings_changed', TG_TABLE_NAME); RETURN NULL; END $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS prices_notify ON prices;
+        CREATE TRIGGER prices_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON prices FOR EACH STATEMENT EXECUTE FUNCTION notify_settings_changed();
+        DROP TRIGGER IF EXISTS admins_notify ON admins;
+        CREATE TRIGGER admins_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON admins FOR EACH STATEMENT EXECUTE FUNCTION notify_settings_changed();
+
+        -- Balans/limit/blok o'zgarsa boshqa jarayonlar user keshini tashlaydi
+        CREATE OR REPLACE FUNCTION notify_user_changed() RETURNS trigger AS $$
+        BEGIN PERFORM pg_notify('user_changed', NEW.user_id::text); RETURN NULL; END $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS users_notify ON users;
+        CREATE TRIGGER users_notify AFTER UPDATE OF balance, free_pptx, free_docx, free_pdf, is_blocked ON users
+            FOR EACH ROW EXECUTE FUNCTION notify_user_changed();
+    """),
+    (2, "sanalar timestamptz", """
+        -- Eski yozuvlar '%Y-%m-%d [%H:%M]' yoki isoformat matn; tanib bo'lmaganlari NULL bo'ladi
+        CREATE OR REPLACE FUNCTION pg_temp.to_ts(t TEXT) RETURNS TIMESTAMPTZ AS $$
+        BEGIN RETURN t::timestamptz; EXCEPTION WHEN others THEN RETURN NULL; END $$ LANGUAGE plpgsql;
+        ALTER TABLE users ALTER COLUMN joined_date TYPE TIMESTAMPTZ USING pg_temp.to_ts(joined_date), ALTER COLUMN joined_date SET DEFAULT now();
+        ALTER TABLE history ALTER COLUMN date TYPE TIMESTAMPTZ USING pg_temp.to_ts(date), ALTER COLUMN date SET DEFAULT now();
+        ALTER TABLE transactions ALTER COLUMN date TYPE TIMESTAMPTZ USING pg_temp.to_ts(date), ALTER COLUMN date SET DEFAULT now();
+        ALTER TABLE admins ALTER COLUMN added_date TYPE TIMESTAMPTZ USING pg_temp.to_ts(added_date), ALTER COLUMN added_date SET DEFAULT now();
+        DROP FUNCTION pg_temp.to_ts(TEXT);
+    """),
+    (3, "history/transactions indekslari", """
+        CREATE INDEX IF NOT EXISTS history_user_idx ON history (user_id);
+        CREATE INDEX IF NOT EXISTS history_date_idx ON history (date);
+        CREATE INDEX IF NOT EXISTS transactions_user_date_idx ON transactions (user_id, date);
+    """),
+    (4, "kunlik statistika", """
+        ALTER TABLE history ADD COLUMN IF NOT EXISTS fmt TEXT;
+        CREATE INDEX IF NOT EXISTS transactions_date_idx ON transactions (date);
+        CREATE INDEX IF NOT EXISTS users_referred_joined_idx ON users (joined_date) WHERE referral_id <> 0;
+        CREATE INDEX IF NOT EXISTS jobs_updated_idx ON jobs (updated_at);
+        CREATE INDEX IF NOT EXISTS reservations_updated_idx ON reservations (updated_at);
+
+        -- Kunlik yig'indilar: admin statistikasi faqat shu jadvaldan o'qiydi
+        CREATE TABLE IF NOT EXISTS daily_stats (day DATE, metric TEXT, dim TEXT, value BIGINT, PRIMARY KEY (day, metric, dim));
+
+        -- since kunidan boshlab qayta hisoblaydi (indekslangan oraliqlar); bir vaqtda bitta jarayon
+        CREATE OR REPLACE FUNCTION refresh_daily_stats(since DATE) RETURNS void AS $$
+        BEGIN
+            IF NOT pg_try_advisory_xact_lock(7243502) THEN RETURN; END IF;
+            DELETE FROM daily_stats WHERE day >= since;
+            INSERT INTO daily_stats (day, metric, dim, value)
+            SELECT date::date, 'orders', doc_type || '/' || coalesce(fmt, '?'), count(*) FROM history WHERE date >= since GROUP BY 1, 3
+            UNION ALL
+            SELECT date::date, 'money', type, sum(amount) FROM transactions WHERE date >= since GROUP BY 1, 3
+            UNION ALL
+            SELECT updated_at::date, 'usage', CASE WHEN kind = 'balance' THEN 'paid' ELSE 'free' END, count(*)
+            FROM reservations WHERE status = 'committed' AND updated_at >= since GROUP BY 1, 3
+            UNION ALL
+            SELECT joined_date::date, 'referrals', 'signup', count(*) FROM users WHERE referral_id <> 0 AND joined_date >= since GROUP BY 1
+            UNION ALL
+            SELECT h.date::date, 'referrals', 'first_order', count(DISTINCT h.user_id)
+            FROM history h JOIN users u ON u.user_id = h.user_id
+            WHERE u.referral_id <> 0 AND h.date >= since AND NOT EXISTS (SELECT 1 FROM history p WHERE p.user_id = h.user_id AND p.date < h.date)
+            GROUP BY 1
+            UNION ALL
+            SELECT updated_at::date, 'jobs', CASE WHEN status = 'done' THEN 'done' WHEN error IN ('llm', 'render', 'stale') THEN error ELSE 'other' END, count(*)
+            FROM jobs WHERE status IN ('done', 'failed') AND updated_at >= since GROUP BY 1, 3;
+        END $$ LANGUAGE plpgsql;
+        SELECT refresh_daily_stats('-infinity');
+    """),
+    (5, "yuborilgan fayllar (file_id)", """
+        -- Bir xil hujjat qayta so'ralsa Telegram dagi nusxa file_id orqali yuboriladi
+        CREATE TABLE IF NOT EXISTS sent_files (
+            key TEXT PRIMARY KEY, file_id TEXT NOT NULL, fmt TEXT, size INTEGER,
+            created_at TIMESTAMPTZ DEFAULT now(), last_used TIMESTAMPTZ DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS sent_files_used_idx ON sent_files (last_used);
+    """),
+    (6, "statistika: chala yozilgan ishlar", """
+        -- Bo'limi yozilmagan ('...') bo'lsa ham yuborilgan ishlar 'partial' bo'lib alohida sanaladi
+        CREATE OR REPLACE FUNCTION refresh_daily_stats(since DATE) RETURNS void AS $$
+        BEGIN
+            IF NOT pg_try_advisory_xact_lock(7243502) THEN RETURN; END IF;
+            DELETE FROM daily_stats WHERE day >= since;
+            INSERT INTO daily_stats (day, metric, dim, value)
+            SELECT date::date, 'orders', doc_type || '/' || coalesce(fmt, '?'), count(*) FROM history WHERE date >= since GROUP BY 1, 3
+            UNION ALL
+            SELECT date::date, 'money', type, sum(amount) FROM transactions WHERE date >= since GROUP BY 1, 3
+            UNION ALL
+            SELECT updated_at::date, 'usage', CASE WHEN kind = 'balance' THEN 'paid' ELSE 'free' END, count(*)
+            FROM reservations WHERE status = 'committed' AND updated_at >= since GROUP BY 1, 3
+            UNION ALL
+            SELECT joined_date::date, 'referrals', 'signup', count(*) FROM users WHERE referral_id <> 0 AND joined_date >= since GROUP BY 1
+            UNION ALL
+            SELECT h.date::date, 'referrals', 'first_order', count(DISTINCT h.user_id)
+            FROM history h JOIN users u ON u.user_id = h.user_id
+            WHERE u.referral_id <> 0 AND h.date >= since AND NOT EXISTS (SELECT 1 FROM history p WHERE p.user_id = h.user_id AND p.date < h.date)
+            GROUP BY 1
+            UNION ALL
+            SELECT updated_at::date, 'jobs', CASE WHEN status = 'done' AND error = 'partial' THEN 'partial' WHEN status = 'done' THEN 'done' WHEN error IN ('llm', 'render', 'stale') THEN error ELSE 'other' END, count(*)
+            FROM jobs WHERE status IN ('done', 'failed') AND updated_at >= since GROUP BY 1, 3;
+        END $$ LANGUAGE plpgsql;
+    """),
+]
+MIGRATION_LOCK = 7243501 # pg_advisory_lock kaliti: bir vaqtda bitta jarayon migratsiya qiladi
+
+async def migrate(conn):
+    if await conn.fetchval("SELECT to_regclass('schema_version')") and \
+       await conn.fetchval("SELECT max(version) FROM schema_version") == MIGRATIONS[-1][0]: return # Hammasi bajarilgan: tez start
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK)
+    try:
+        await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name TEXT, applied_at TIMESTAMPTZ DEFAULT now())")
+        done = await conn.fetchval("SELECT coalesce(max(version), 0) FROM schema_version")
+        for version, name, sql in MIGRATIONS:
+            if version <= done: continue
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute("INSERT INTO schema_version (version, name) VALUES ($1, $2)", version, name)
+            print(f"🛠 Migratsiya {version}: {name}")
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK)
+
 async def init_db():
     global pool
     try:
-        pool = await asyncpg.create_pool(dsn=DATABASE_URL, min_size=1, max_size=10)
+        pool = await make_pool(DATABASE_URL, min_size=1, max_size=10, init=init_conn)
         async with pool.acquire() as conn:
-            # Users jadvali
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY, username TEXT, full_name TEXT, 
-                    balance INTEGER DEFAULT 0, 
-                    free_pptx INTEGER DEFAULT 2, free_docx INTEGER DEFAULT 2, free_pdf INTEGER DEFAULT 2,
-                    referral_id BIGINT DEFAULT 0, invited_count INTEGER DEFAULT 0,
-                    is_blocked INTEGER DEFAULT 0, joined_date TEXT
-                )
-            """)
-            try:
-                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked INTEGER DEFAULT 0")
-                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_id BIGINT DEFAULT 0")
-                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS invited_count INTEGER DEFAULT 0")
-                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS free_pdf INTEGER DEFAULT 2")
-            except: pass
-
-            # History jadvali
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS history (
-                    id SERIAL PRIMARY KEY, user_id BIGINT, 
-                    doc_type TEXT, topic TEXT, pages INTEGER,
-                    student TEXT, uni TEXT, faculty TEXT, grp TEXT, subject TEXT, teacher TEXT,
-                    date TEXT
-                )
-            """)
-            try:
-                await conn.execute("ALTER TABLE history ADD COLUMN IF NOT EXISTS student TEXT DEFAULT '-'")
-                await conn.execute("ALTER TABLE history ADD COLUMN IF NOT EXISTS uni TEXT DEFAULT '-'")
-                await conn.execute("ALTER TABLE history ADD COLUMN IF NOT EXISTS faculty TEXT DEFAULT '-'")
-                await conn.execute("ALTER TABLE history ADD COLUMN IF NOT EXISTS grp TEXT DEFAULT '-'")
-                await conn.execute("ALTER TABLE history ADD COLUMN IF NOT EXISTS subject TEXT DEFAULT '-'")
-                await conn.execute("ALTER TABLE history ADD COLUMN IF NOT EXISTS teacher TEXT DEFAULT '-'")
-            except: pass
-            
-            # Boshqa jadvallar
-            await conn.execute("CREATE TABLE IF NOT EXISTS transactions (id SERIAL PRIMARY KEY, user_id BIGINT, amount INTEGER, date TEXT, type TEXT)")
-            await conn.execute("CREATE TABLE IF NOT EXISTS prices (key TEXT PRIMARY KEY, value INTEGER)")
-            await conn.execute("CREATE TABLE IF NOT EXISTS admins (user_id BIGINT PRIMARY KEY, added_date TEXT)")
-            
+            await migrate(conn)
             for k, v in DEFAULT_PRICES.items():
                 await conn.execute("INSERT INTO prices (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING", k, v)
             if ADMIN_ID:
-                await conn.execute("INSERT INTO admins (user_id, added_date) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING", ADMIN_ID, datetime.now().isoformat())
-            print("✅ Baza yuklandi.")
-    except Exception as e: print(f"DB Error: {e}")
+                await conn.execute("INSERT INTO admins (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING", ADMIN_ID)
+        await load_settings()
+        print("✅ Baza yuklandi.")
+    except Exception as e: report_error("db", f"DB Error: {e}")
+
+# Narxlar va adminlar keshi (kichik jadvallar, to'liq xotirada)
+prices_cache = {}
+admins_cache = set()
+
+async def load_settings():
+    async with pool.acquire() as conn:
+        prices = await conn.fetch("SELECT key, value FROM prices")
+        admins = await conn.fetch("SELECT user_id FROM admins")
+    prices_cache.clear(); prices_cache.update({r['key']: r['value'] for r in prices})
+    admins_cache.clear(); admins_cache.update(r['user_id'] for r in admins)
 
 # DB Funksiyalari
-async def get_user(uid):
+# Userlar keshi: qisqa muddatli, o'zgarishlarda (shu jarayonda va NOTIFY orqali) yangilanadi
+user_cache = {} # uid -> (muddati, dict)
+
+def cache_user(row):
+    if row is None: return None
+    u = {k: v for k, v in dict(row).items() if k not in ('inserted', 'referred')}
+    user_cache[u['user_id']] = (time.monotonic() + USER_CACHE_TTL, u)
+    if len(user_cache) > 50000: user_cache.clear()
+    return u
+
+def forget_user(uid):
+    user_cache.pop(uid, None)
+
+async def get_user(uid, fresh=False):
     if not pool: return None
-    async with pool.acquire() as conn: return await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", uid)
+    hit = user_cache.get(uid)
+    if hit and not fresh and hit[0] > time.monotonic(): return hit[1]
+    async with pool.acquire() as conn: return cache_user(await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", uid))
 
 async def create_user(uid, uname, fname, referrer_id=0):
-    if not pool: return False
+    # Bitta so'rov: yangi user qo'shiladi yoki ismi yangilanadi, referal bonusi ham shu yerda.
+    # Qaytaradi: (user, referal bonusi berildimi)
+    if not pool: return None, False
     async with pool.acquire() as conn:
-        exists = await conn.fetchval("SELECT user_id FROM users WHERE user_id=$1", uid)
-        if not exists:
-            await conn.execute("""
-                INSERT INTO users (user_id, username, full_name, referral_id, joined_date) 
-                VALUES ($1, $2, $3, $4, $5)
-            """, uid, uname, fname, referrer_id, datetime.now().strftime("%Y-%m-%d"))
-            if referrer_id != 0 and referrer_id != uid:
-                try:
-                    await conn.execute("UPDATE users SET balance = balance + $1, invited_count = invited_count + 1 WHERE user_id = $2", REFERRAL_BONUS, referrer_id)
-                    await conn.execute("INSERT INTO transactions (user_id, amount, date, type) VALUES ($1, $2, $3, 'referral_bonus')", referrer_id, REFERRAL_BONUS, datetime.now().strftime("%Y-%m-%d %H:%M"))
-                    return True
-                except: pass
-        else:
-            await conn.execute("UPDATE users SET full_name=$1, username=$2 WHERE user_id=$3", fname, uname, uid)
-        return False
+        row = await conn.fetchrow("""
+            WITH u AS (
+                INSERT INTO users (user_id, username, full_name, referral_id) VALUES ($1, $2, $3, $4)
+                ON CONFLICT (user_id) DO UPDATE SET full_name = EXCLUDED.full_name, username = EXCLUDED.username, bot_blocked = 0
+                RETURNING *, (xmax = 0) AS inserted
+            ), ref AS (
+                UPDATE users SET balance = balance + $5, invited_count = invited_count + 1
+                WHERE user_id = $4 AND $4 <> 0 AND $4 <> $1 AND (SELECT inserted FROM u)
+                RETURNING user_id
+            ), tx AS (
+                INSERT INTO transactions (user_id, amount, date, type) SELECT user_id, $5, now(), 'referral_bonus' FROM ref
+            )
+            SELECT u.*, EXISTS (SELECT 1 FROM ref) AS referred FROM u
+        """, uid, uname, fname, referrer_id, REFERRAL_BONUS)
+    if row['referred']: forget_user(referrer_id)
+    return cache_user(row), row['referred']
 
 async def update_balance(uid, amount, type="payment"):
-    async with pool.acquire() as conn: 
-        await conn.execute("UPDATE users SET balance = balance + $1 WHERE user_id = $2", amount, uid)
-        await conn.execute("INSERT INTO transactions (user_id, amount, date, type) VALUES ($1, $2, $3, $4)", uid, amount, datetime.now().strftime("%Y-%m-%d %H:%M"), type)
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow("UPDATE users SET balance = balance + $1 WHERE user_id = $2 RETURNING *", amount, uid)
+            await conn.execute("INSERT INTO transactions (user_id, amount, date, type) VALUES ($1, $2, now(), $3)", uid, amount, type)
+    return cache_user(row)
 
 async def update_limit(uid, col, val):
-    async with pool.acquire() as conn: await conn.execute(f"UPDATE users SET {col} = {col} + $1 WHERE user_id = $2", val, uid)
+    async with pool.acquire() as conn: return cache_user(await conn.fetchrow(f"UPDATE users SET {col} = {col} + $1 WHERE user_id = $2 RETURNING *", val, uid))
 
-async def add_full_hist(uid, dtype, topic, pages, info):
+async def add_full_hist(uid, dtype, topic, pages, info, fmt=None):
     async with pool.acquire() as conn:
         await conn.execute("""
-            INSERT INTO history (user_id, doc_type, topic, pages, student, uni, faculty, grp, subject, teacher, date) 
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+            INSERT INTO history (user_id, doc_type, topic, pages, student, uni, faculty, grp, subject, teacher, date, fmt) 
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, now(), $11)
         """, uid, dtype, topic, pages, 
-           info.get('student'), info.get('edu_place'), info.get('direction'), info.get('group'), info.get('subject'), info.get('teacher'),
-           datetime.now().strftime("%Y-%m-%d %H:%M"))
+           info.get('student'), info.get('edu_place'), info.get('direction'), info.get('group'), info.get('subject'), info.get('teacher'), fmt)
+
+async def enqueue_job(uid, chat_id, status_msg_id, payload, status='queued'):
+    # status='waiting': oldindan yozilayotgan reja tugashini kutadi.
+    # Narx shu tranzaksiyada band qilinadi (avval bepul limit, keyin balans); yetmasa None qaytadi
+    limit_key, cost = payload['limit_key'], payload['cost']
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            kind, amount = limit_key, 1
+            row = await conn.fetchrow(f"UPDATE users SET {limit_key} = {limit_key} - 1 WHERE user_id=$1 AND {limit_key} > 0 RETURNING *", uid)
+            if not row:
+                kind, amount = 'balance', cost
+                row = await conn.fetchrow("UPDATE users SET balance = balance - $2 WHERE user_id=$1 AND balance >= $2 RETURNING *", uid, cost)
+            if not row: return None
+            job_id = await conn.fetchval("INSERT INTO jobs (user_id, chat_id, status_msg_id, payload, status) VALUES ($1, $2, $3, $4, $5) RETURNING id", uid, chat_id, status_msg_id, payload, status)
+            await conn.execute("INSERT INTO reservations (job_id, user_id, kind, amount) VALUES ($1, $2, $3, $4)", job_id, uid, kind, amount)
+            if status == 'queued': await conn.execute("SELECT pg_notify('jobs_new', $1)", str(job_id))
+    cache_user(row)
+    return job_id
+
+async def release_job(job_id, prefetched=None):
+    async with pool.acquire() as conn:
+        await conn.execute("UPDATE jobs SET status='queued', updated_at=now(), payload = payload || jsonb_build_object('prefetched', $2::jsonb) WHERE id=$1 AND status='waiting'", job_id, prefetched)
+        await conn.execute("SELECT pg_notify('jobs_new', $1)", str(job_id))
+
+async def release_after_prefetch(job_id, task):
+    try: await asyncio.wait({task})
+    finally: await release_job(job_id, prefetch_result(task) if task.done() else None)
+
+async def queued_jobs_count():
+    async with pool.acquire() as conn: return await conn.fetchval("SELECT count(*) FROM jobs WHERE status='queued'")
+
+async def claim_job():
+    # Bir nechta ishchi bir-biriga xalaqit bermaydi (SKIP LOCKED); to'lov oldindan band qilingani uchun
+    # bitta userning ishlari ham parallel bajarilishi mumkin
+    async with pool.acquire() as conn:
+        return await conn.fetchrow("""
+            UPDATE jobs SET status='running', attempts=attempts+1, updated_at=now()
+            WHERE id = (SELECT id FROM jobs WHERE status='queued' ORDER BY id FOR UPDATE SKIP LOCKED LIMIT 1)
+            RETURNING *
+        """)
+
+async def commit_reservation(conn, job_id):
+    # Band qilingan summa yechib olinadi (balans allaqachon kamaygan, faqat tranzaksiya yoziladi)
+    await conn.execute("""
+        WITH r AS (UPDATE reservations SET status='committed', updated_at=now() WHERE job_id=$1 AND status='held' RETURNING *)
+        INSERT INTO transactions (user_id, amount, date, type) SELECT user_id, -amount, now(), 'service_fee' FROM r WHERE kind='balance'
+    """, job_id)
+
+async def release_reservations(conn, job_ids):
+    # Muvaffaqiyatsiz ishlar uchun band qilingan balans/limit qaytariladi
+    await conn.execute("""
+        WITH r AS (UPDATE reservations SET status='released', updated_at=now() WHERE job_id = ANY($1::int[]) AND status='held' RETURNING *)
+        UPDATE users u SET balance = u.balance + s.balance, free_pptx = u.free_pptx + s.free_pptx,
+            free_docx = u.free_docx + s.free_docx, free_pdf = u.free_pdf + s.free_pdf
+        FROM (
+            SELECT user_id,
+                coalesce(sum(amount) FILTER (WHERE kind='balance'), 0) AS balance,
+                coalesce(sum(amount) FILTER (WHERE kind='free_pptx'), 0) AS free_pptx,
+                coalesce(sum(amount) FILTER (WHERE kind='free_docx'), 0) AS free_docx,
+                coalesce(sum(amount) FILTER (WHERE kind='free_pdf'), 0) AS free_pdf
+            FROM r GROUP BY user_id
+        ) s WHERE u.user_id = s.user_id
+    """, list(job_ids))
+
+async def finish_job(job_id, status, error=None):
+    # Ish holati va to'lov bitta tranzaksiyada: 'done' - yechiladi, 'failed' - qaytariladi
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow("UPDATE jobs SET status=$2, error=$3, updated_at=now() WHERE id=$1 RETURNING user_id, payload->>'fmt' AS fmt, extract(epoch FROM now() - created_at) AS age", job_id, status, error)
+            if status == 'done': await commit_reservation(conn, job_id)
+            elif status == 'failed': await release_reservations(conn, [job_id])
+    if not row: return
+    if status != 'queued': JOB_SECONDS.labels(row['fmt'], status).observe(float(row['age']))
+    forget_user(row['user_id'])
+
+async def touch_job(job_id):
+    async with pool.acquire() as conn: await conn.execute("UPDATE jobs SET updated_at=now() WHERE id=$1", job_id)
+
+async def requeue_stale_jobs():
+    # Ishchi jarayon o'lib qolsa, uning ishlari qayta navbatga qo'yiladi
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            ids = await conn.fetch("UPDATE jobs SET status='failed', error='stale' WHERE status='running' AND updated_at < now() - make_interval(secs => $1) AND attempts >= $2 RETURNING id", JOB_STALE_SECONDS, JOB_MAX_ATTEMPTS)
+            if ids: await release_reservations(conn, [r['id'] for r in ids])
+        # Oldindan yozish natijasini kutib qolgan ishlar ham bo'shatiladi
+        await conn.execute("UPDATE jobs SET status='queued' WHERE status='waiting' AND updated_at < now() - make_interval(secs => $1)", PREFETCH_TIMEOUT + 60)
+        return await conn.fetchval("WITH r AS (UPDATE jobs SET status='queued' WHERE status='running' AND updated_at < now() - make_interval(secs => $1) RETURNING 1) SELECT count(*) FROM r", JOB_STALE_SECONDS)
 
 async def get_price(key):
-    if not pool: return DEFAULT_PRICES.get(key, 5000)
-    async with pool.acquire() as conn: 
-        val = await conn.fetchval("SELECT value FROM prices WHERE key=$1", key)
-        return val if val else DEFAULT_PRICES.get(key, 5000)
+    # Keshdan o'qiladi: bazaga so'rov ketmaydi
+    return prices_cache.get(key) or DEFAULT_PRICES.get(key, 5000)
 
 async def set_price(key, val):
     async with pool.acquire() as conn: await conn.execute("INSERT INTO prices (key, value) VALUES ($1, $2) ON CONFLICT (key) DO UPDATE SET value=$2", key, val)
+    prices_cache[key] = val # Boshqa jarayonlar trigger orqali (NOTIFY) yangilanadi
 
 async def is_admin(uid):
-    if uid == ADMIN_ID: return True
-    async with pool.acquire() as conn:
-        res = await conn.fetchval("SELECT user_id FROM admins WHERE user_id=$1", uid)
-        return res is not None
+    return uid == ADMIN_ID or uid in admins_cache
 
 async def get_admins():
+    return list(admins_cache)
+
+async def create_broadcast(admin_id, from_chat_id, message_id):
     async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id FROM admins")
-        return [r['user_id'] for r in rows]
+        return await conn.fetchval("""
+            INSERT INTO broadcasts (admin_id, from_chat_id, message_id, total, updated_at)
+            VALUES ($1, $2, $3, (SELECT count(*) FROM users WHERE bot_blocked = 0), now() - interval '1 day') RETURNING id
+        """, admin_id, from_chat_id, message_id)
+
+async def claim_broadcasts(owner, skip_ids):
+    # Hech kim yurgizmayotgan (yoki egasi o'lgan) tarqatishlarni olish
+    async with pool.acquire() as conn:
+        return await conn.fetch("""
+            UPDATE broadcasts SET owner=$1, updated_at=now()
+            WHERE status='running' AND updated_at < now() - make_interval(secs => $2) AND NOT (id = ANY($3)) RETURNING *
+        """, owner, BC_STALE_SECONDS, skip_ids)
+
+async def broadcast_batch(last_uid):
+    async with pool.acquire() as conn:
+        return [r['user_id'] for r in await conn.fetch("SELECT user_id FROM users WHERE user_id > $1 AND bot_blocked = 0 ORDER BY user_id LIMIT $2", last_uid, BC_BATCH)]
+
+async def save_broadcast_progress(bc_id, owner, last_uid, sent, failed, blocked_ids):
+    # Kursor va hisoblar bitta tranzaksiyada: qayta ishga tushganda shu joydan davom etadi
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if blocked_ids: await conn.execute("UPDATE users SET bot_blocked = 1 WHERE user_id = ANY($1)", blocked_ids)
+            return await conn.fetchrow("""
+                UPDATE broadcasts SET last_uid=$3, sent=sent+$4, failed=failed+$5, blocked=blocked+$6, updated_at=now()
+                WHERE id=$1 AND owner=$2 RETURNING *
+            """, bc_id, owner, last_uid, sent, failed, len(blocked_ids))
+
+async def finish_broadcast(bc_id, owner, status):
+    async with pool.acquire() as conn:
+        await conn.execute("UPDATE broadcasts SET status=$3, updated_at=now() WHERE id=$1 AND owner=$2 AND status='running'", bc_id, owner, status)
+
+async def stop_broadcast(bc_id):
+    async with pool.acquire() as conn:
+        await conn.execute("UPDATE broadcasts SET status='cancelled' WHERE id=$1 AND status='running'", bc_id)
 
 async def set_user_block(uid, block_status): # 1 = blocked, 0 = active
     async with pool.acquire() as conn:
-        await conn.execute("UPDATE users SET is_blocked=$1 WHERE user_id=$2", block_status, uid)
+        return cache_user(await conn.fetchrow("UPDATE users SET is_blocked=$1 WHERE user_id=$2 RETURNING *", block_status, uid))
+
+async def refresh_stats(days=STATS_REFRESH_DAYS):
+    # Oxirgi kunlar qayta hisoblanadi (kech tugagan ishlar, qaytarilgan to'lovlar ham kiradi)
+    async with pool.acquire() as conn: await conn.execute("SELECT refresh_daily_stats(current_date - $1::int)", days - 1)
+
+async def get_stats():
+    # Bugun / 7 kun / 30 kun yig'indilari va oxirgi 7 kunlik buyurtmalar (faqat daily_stats dan)
+    async with pool.acquire() as conn:
+        totals = await conn.fetch("""
+            SELECT metric, dim, sum(value) FILTER (WHERE day = current_date) AS d1,
+                sum(value) FILTER (WHERE day > current_date - 7) AS d7, sum(value) AS d30
+            FROM daily_stats WHERE day > current_date - 30 GROUP BY metric, dim ORDER BY metric, dim
+        """)
+        daily = await conn.fetch("SELECT day, sum(value) AS n FROM daily_stats WHERE day > current_date - 7 AND metric = 'orders' GROUP BY day ORDER BY day")
+    return totals, daily
 
 # ==============================================================================
 # ENGINES (HUJJAT YARATISH)
@@ -230,176 +738,929 @@ def extract_json_array(text):
     except: return []
 
 PPTX_THEMES = {
-    "modern_blue": {"bg": (240,248,255), "main": (0,51,102), "txt": (20,20,40), "shape": MSO_SHAPE.ROUNDED_RECTANGLE},
-    "elegant_dark": {"bg": (30,30,35), "main": (255,215,0), "txt": (240,240,240), "shape": MSO_SHAPE.RECTANGLE},
-    "nature_green": {"bg": (240,255,240), "main": (34,139,34), "txt": (10,30,10), "shape": MSO_SHAPE.SNIP_2_DIAG_RECTANGLE},
-    "creative_orange": {"bg": (255,250,240), "main": (255,69,0), "txt": (50,20,0), "shape": MSO_SHAPE.OVAL},
-    "cyber_purple": {"bg": (20,0,30), "main": (0,255,255), "txt": (255,255,255), "shape": MSO_SHAPE.HEXAGON},
-    "minimal_gray": {"bg": (255,255,255), "main": (80,80,80), "txt": (0,0,0), "shape": MSO_SHAPE.RECTANGLE},
-    "ocean_teal": {"bg": (224,255,255), "main": (0,128,128), "txt": (0,50,50), "shape": MSO_SHAPE.WAVE},
-    "royal_gold": {"bg": (40,0,0), "main": (255,215,0), "txt": (255,250,200), "shape": MSO_SHAPE.PLAQUE},
-    "startup_red": {"bg": (255,245,245), "main": (220,20,60), "txt": (20,0,0), "shape": MSO_SHAPE.ROUNDED_RECTANGLE},
-    "sky_light": {"bg": (230,245,255), "main": (30,144,255), "txt": (0,20,50), "shape": MSO_SHAPE.CLOUD},
+    "modern_blue": {"bg": (240,248,255), "main": (0,51,102), "txt": (20,20,40), "shape": "ROUNDED_RECTANGLE"},
+    "elegant_dark": {"bg": (30,30,35), "main": (255,215,0), "txt": (240,240,240), "shape": "RECTANGLE"},
+    "nature_green": {"bg": (240,255,240), "main": (34,139,34), "txt": (10,30,10), "shape": "SNIP_2_DIAG_RECTANGLE"},
+    "creative_orange": {"bg": (255,250,240), "main": (255,69,0), "txt": (50,20,0), "shape": "OVAL"},
+    "cyber_purple": {"bg": (20,0,30), "main": (0,255,255), "txt": (255,255,255), "shape": "HEXAGON"},
+    "minimal_gray": {"bg": (255,255,255), "main": (80,80,80), "txt": (0,0,0), "shape": "RECTANGLE"},
+    "ocean_teal": {"bg": (224,255,255), "main": (0,128,128), "txt": (0,50,50), "shape": "WAVE"},
+    "royal_gold": {"bg": (40,0,0), "main": (255,215,0), "txt": (255,250,200), "shape": "PLAQUE"},
+    "startup_red": {"bg": (255,245,245), "main": (220,20,60), "txt": (20,0,0), "shape": "ROUNDED_RECTANGLE"},
+    "sky_light": {"bg": (230,245,255), "main": (30,144,255), "txt": (0,20,50), "shape": "CLOUD"},
 }
 
-def create_presentation(data_list, info, design="modern_blue"):
-    prs = Presentation()
-    th = PPTX_THEMES.get(design, PPTX_THEMES["modern_blue"])
-    bg_rgb = PptxRGB(*th["bg"])
-    main_rgb = PptxRGB(*th["main"])
-    txt_rgb = PptxRGB(*th["txt"])
+def pptx_text_style(ph, size, rgb, bold=False, align="ctr", space_after=0):
+    # Placeholder matn uslubi (lstStyle): slaydlardagi matn shu yerdan meros oladi
+    txBody = ph.text_frame._txBody
+    for old in txBody.findall(qn("a:lstStyle")): txBody.remove(old)
+    lst = parse_xml(
+        f'<a:lstStyle {nsdecls("a")}><a:lvl1pPr marL="0" indent="0" algn="{align}">'
+        + (f'<a:spcBef><a:spcPts val="0"/></a:spcBef><a:spcAft><a:spcPts val="{space_after * 100}"/></a:spcAft>' if space_after else '')
+        + f'<a:buNone/><a:defRPr sz="{size * 100}" b="{int(bold)}"><a:solidFill><a:srgbClr val="{rgb}"/></a:solidFill></a:defRPr></a:lvl1pPr></a:lstStyle>'
+    )
+    txBody.insert(txBody.index(txBody.find(qn("a:bodyPr"))) + 1, lst)
 
-    # Title Slide
-    slide = prs.slides.add_slide(prs.slide_layouts[6])
-    slide.background.fill.solid(); slide.background.fill.fore_color.rgb = bg_rgb
-    
-    shape = slide.shapes.add_shape(th['shape'], PptxInches(0.5), PptxInches(0.5), PptxInches(9), PptxInches(6.5))
-    shape.fill.background(); shape.line.color.rgb = main_rgb; shape.line.width = PptxPt(4)
-    
-    tb = slide.shapes.add_textbox(PptxInches(1), PptxInches(2), PptxInches(8), PptxInches(2.5))
-    p = tb.text_frame.add_paragraph()
-    p.text = info['topic'].upper()
-    p.font.size = PptxPt(40); p.font.bold = True; p.font.color.rgb = main_rgb; p.alignment = PP_ALIGN.CENTER
-    
-    ib = slide.shapes.add_textbox(PptxInches(1), PptxInches(5), PptxInches(8), PptxInches(2))
-    tf = ib.text_frame
-    details = f"Bajardi: {info['student']}\nGuruh: {info['group']}\nQabul qildi: {info['teacher']}"
-    for line in details.split('\n'):
-        p = tf.add_paragraph(); p.text = line; p.font.size = PptxPt(18); p.font.color.rgb = txt_rgb; p.alignment = PP_ALIGN.CENTER
-
-    # Content Slides
-    for item in data_list:
-        slide = prs.slides.add_slide(prs.slide_layouts[6])
-        slide.background.fill.solid(); slide.background.fill.fore_color.rgb = bg_rgb
-        
-        head = slide.shapes.add_shape(MSO_SHAPE.RECTANGLE, 0, 0, PptxInches(10), PptxInches(1.2))
-        head.fill.solid(); head.fill.fore_color.rgb = main_rgb
-        
-        ht = slide.shapes.add_textbox(PptxInches(0.5), PptxInches(0.2), PptxInches(9), PptxInches(0.8))
-        hp = ht.text_frame.add_paragraph(); hp.text = clean_text(item['title']); hp.font.size = PptxPt(32); hp.font.bold = True; hp.font.color.rgb = PptxRGB(255,255,255); hp.alignment = PP_ALIGN.CENTER
-        
-        bt = slide.shapes.add_textbox(PptxInches(0.5), PptxInches(1.5), PptxInches(9), PptxInches(5.5))
-        tf = bt.text_frame; tf.word_wrap = True
+def pptx_place(ph, left, top, width, height):
+    ph.left, ph.top, ph.width, ph.height = PptxInches(left), PptxInches(top), PptxInches(width), PptxInches(height)
+
+@functools.lru_cache(maxsize=None)
+def pptx_template(design):
+    # Mavzu bir marta (har jarayonda) tayyorlanadi: fon, bezaklar va matn uslublari
+    # maket (layout) ichida turadi, har bir slaydda faqat matn yoziladi
+    load_engines()
+    th = PPTX_THEMES.get(design, PPTX_THEMES["modern_blue"])
+    main_hex, txt_hex = "%02X%02X%02X" % th["main"], "%02X%02X%02X" % th["txt"]
+    prs = Presentation()
+    layouts = prs.slide_layouts
+
+    # Bezak shakllari shu taqdimotning vaqtinchalik slaydida (o'z "Blank" maketi) chiziladi,
+    # XML nusxasi olinadi va slayd o'chiriladi
+    scratch = prs.slides.add_slide(layouts[6]).shapes
+    frame = scratch.add_shape(getattr(MSO_SHAPE, th['shape']), PptxInches(0.5), PptxInches(0.5), PptxInches(9), PptxInches(6.5))
+    frame.fill.background(); frame.line.color.rgb = PptxRGB(*th["main"]); frame.line.width = PptxPt(4)
+    head = scratch.add_shape(MSO_SHAPE.RECTANGLE, 0, 0, PptxInches(10), PptxInches(1.2))
+    head.fill.solid(); head.fill.fore_color.rgb = PptxRGB(*th["main"]); head.line.fill.background()
+    decos = [copy.deepcopy(frame._element), copy.deepcopy(head._element)]
+    sld_id = prs.slides._sldIdLst[-1]
+    prs.slides._sldIdLst.remove(sld_id); prs.part.drop_rel(sld_id.rId)
+
+    for layout in list(layouts)[2:]: layouts.remove(layout) # Keraksiz maketlar saqlanmaydi
+    cover, content = layouts[0], layouts[1]
+    prs.slide_master.background.fill.solid(); prs.slide_master.background.fill.fore_color.rgb = PptxRGB(*th["bg"])
+
+    for layout, el in zip((cover, content), decos):
+        for ph in list(layout.placeholders):
+            if ph.placeholder_format.idx >= 10: ph._element.getparent().remove(ph._element) # Sana/footer/raqam
+        el.nvSpPr.cNvPr.id = layout.shapes._next_shape_id
+        layout.shapes._spTree.insert(2, el) # Placeholderlar ostida
+
+    title, sub = cover.placeholders[0], cover.placeholders[1]
+    pptx_place(title, 1, 2, 8, 2.5); pptx_text_style(title, 40, main_hex, bold=True)
+    pptx_place(sub, 1, 5, 8, 2); pptx_text_style(sub, 18, txt_hex)
+    title, body = content.placeholders[0], content.placeholders[1]
+    pptx_place(title, 0.5, 0.2, 9, 0.8); pptx_text_style(title, 32, "FFFFFF", bold=True)
+    pptx_place(body, 0.5, 1.5, 9, 5.5); pptx_text_style(body, 24, txt_hex, align="l", space_after=10)
+    body.text_frame._bodyPr.set("anchor", "t")
+
+    out = BytesIO(); prs.save(out); return out.getvalue()
+
+# Builderlar: muqova/mundarija darhol, bo'limlar kelishi bilan qo'shiladi, finish() faylni saqlaydi.
+# Bo'limlar ham ro'yxatdan (create_*), ham navbatdan (render_stream) shu yo'l bilan teriladi
+class PptxBuilder:
+    def __init__(self, info, design="modern_blue", titles=None):
+        load_engines()
+        self.prs = Presentation(BytesIO(pptx_template(design)))
+        cover, self.layout = self.prs.slide_layouts[0], self.prs.slide_layouts[1]
+
+        # Title Slide
+        slide = self.prs.slides.add_slide(cover)
+        slide.placeholders[0].text = info['topic'].upper()
+        slide.placeholders[1].text = f"Bajardi: {info['student']}\nGuruh: {info['group']}\nQabul qildi: {info['teacher']}"
+
+    def add(self, item):
+        slide = self.prs.slides.add_slide(self.layout)
+        slide.placeholders[0].text = clean_text(item['title'])
         
         content = clean_text(item['content'])
         length = len(content)
-        fs = 24 if length < 200 else 20 if length < 400 else 16 if length < 600 else 14
+        fs = PptxPt(24 if length < 200 else 20 if length < 400 else 16 if length < 600 else 14)
         
-        for line in content.split('\n'):
-            if len(line.strip()) > 2:
-                p = tf.add_paragraph(); p.text = "• " + line.strip(); p.font.size = PptxPt(fs); p.font.color.rgb = txt_rgb; p.space_after = PptxPt(10)
-
-    out = BytesIO(); prs.save(out); out.seek(0); return out
-
-def create_document(data_list, info, doc_type="Referat"):
-    doc = Document()
-    style = doc.styles['Normal']; style.font.name = 'Times New Roman'; style.font.size = Pt(14); style.paragraph_format.line_spacing = 1.5
-    for s in doc.sections: s.top_margin = Cm(2); s.bottom_margin = Cm(2); s.left_margin = Cm(3); s.right_margin = Cm(1.5)
-
-    for _ in range(4): doc.add_paragraph()
-    p = doc.add_paragraph("O'ZBEKISTON RESPUBLIKASI\nOLIY TA'LIM, FAN VA INNOVATSIYALAR VAZIRLIGI"); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].bold = True
-    if info['edu_place'] != "-": p = doc.add_paragraph(info['edu_place'].upper()); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].bold = True
-    
-    for _ in range(6): doc.add_paragraph()
-    p = doc.add_paragraph(doc_type.upper()); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].font.size = Pt(22); p.runs[0].bold = True
-    p = doc.add_paragraph(f"Mavzu: {info['topic']}"); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].bold = True
-
-    for _ in range(5): doc.add_paragraph()
-    table = doc.add_table(rows=5, cols=2); table.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    def fill_row(idx, label, val):
-        if val != "-": cell = table.rows[idx].cells[1]; p = cell.paragraphs[0]; r = p.add_run(f"{label}: {val}"); r.bold = True; r.font.size = Pt(14)
-    fill_row(0, "Bajardi", info['student']); fill_row(1, "Guruh", info['group']); fill_row(2, "Fakultet", info['direction']); fill_row(3, "Fan", info['subject']); fill_row(4, "Qabul qildi", info['teacher'])
-    
-    doc.add_page_break()
-    p = doc.add_paragraph("MUNDARIJA"); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].bold=True
-    for item in data_list: doc.add_paragraph(item['title'])
-    doc.add_page_break()
+        tf = slide.placeholders[1].text_frame
+        lines = [line.strip() for line in content.split('\n') if len(line.strip()) > 2]
+        for i, line in enumerate(lines):
+            p = tf.paragraphs[0] if i == 0 else tf.add_paragraph()
+            p.text = "• " + line; p.font.size = fs
+
+    def finish(self, out=None):
+        out = out or BytesIO(); self.prs.save(out); out.seek(0); return out
+
+class DocxBuilder:
+    def __init__(self, info, doc_type="Referat", titles=()):
+        load_engines()
+        self.doc = doc = Document()
+        style = doc.styles['Normal']; style.font.name = 'Times New Roman'; style.font.size = Pt(14); style.paragraph_format.line_spacing = 1.5
+        for s in doc.sections: s.top_margin = Cm(2); s.bottom_margin = Cm(2); s.left_margin = Cm(3); s.right_margin = Cm(1.5)
+
+        for _ in range(4): doc.add_paragraph()
+        p = doc.add_paragraph("O'ZBEKISTON RESPUBLIKASI\nOLIY TA'LIM, FAN VA INNOVATSIYALAR VAZIRLIGI"); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].bold = True
+        if info['edu_place'] != "-": p = doc.add_paragraph(info['edu_place'].upper()); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].bold = True
+        
+        for _ in range(6): doc.add_paragraph()
+        p = doc.add_paragraph(doc_type.upper()); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].font.size = Pt(22); p.runs[0].bold = True
+        p = doc.add_paragraph(f"Mavzu: {info['topic']}"); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].bold = True
+
+        for _ in range(5): doc.add_paragraph()
+        table = doc.add_table(rows=5, cols=2); table.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+        def fill_row(idx, label, val):
+            if val != "-": cell = table.rows[idx].cells[1]; p = cell.paragraphs[0]; r = p.add_run(f"{label}: {val}"); r.bold = True; r.font.size = Pt(14)
+        fill_row(0, "Bajardi", info['student']); fill_row(1, "Guruh", info['group']); fill_row(2, "Fakultet", info['direction']); fill_row(3, "Fan", info['subject']); fill_row(4, "Qabul qildi", info['teacher'])
+        
+        doc.add_page_break()
+        p = doc.add_paragraph("MUNDARIJA"); p.alignment = WD_ALIGN_PARAGRAPH.CENTER; p.runs[0].bold=True
+        for title in titles: doc.add_paragraph(title)
+        doc.add_page_break()
 
-    for item in data_list:
+    def add(self, item):
+        doc = self.doc
         h = doc.add_paragraph(clean_text(item['title'])); h.alignment = WD_ALIGN_PARAGRAPH.CENTER; h.runs[0].bold = True; h.runs[0].font.size = Pt(16); h.paragraph_format.space_after = Pt(12)
         for para in clean_text(item['content']).split('\n'):
             if len(para) > 5: p = doc.add_paragraph(para); p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY; p.paragraph_format.first_line_indent = Cm(1.27)
-    
-    out = BytesIO(); doc.save(out); out.seek(0); return out
 
-class PDF(FPDF):
-    def footer(self):
-        self.set_y(-15); self.set_font("DejaVu", '', 10); self.cell(0, 10, f'{self.page_no()}', align='C')
+    def finish(self, out=None):
+        out = out or BytesIO(); self.doc.save(out); out.seek(0); return out
+
+def create_presentation(data_list, info, design="modern_blue", out=None):
+    b = PptxBuilder(info, design)
+    for item in data_list: b.add(item)
+    return b.finish(out)
+
+def create_document(data_list, info, doc_type="Referat", out=None):
+    b = DocxBuilder(info, doc_type, [item['title'] for item in data_list])
+    for item in data_list: b.add(item)
+    return b.finish(out)
+
+def pdf_footer(pdf):
+    pdf.set_y(-15); pdf.set_font("DejaVu", '', 10); pdf.cell(0, 10, f'{pdf.page_no()}', align='C')
+
+@functools.lru_cache(maxsize=None)
+def pdf_font():
+    # TTF bir marta (har jarayonda) o'qiladi va tahlil qilinadi: kengliklar, cmap, glyph id lar
+    load_engines()
+    donor = FPDF(); donor.add_font("DejaVu", "", FONT_PATH)
+    with open(FONT_PATH, 'rb') as f: data = f.read()
+    return donor.fonts["dejavu"], data
+
+def attach_pdf_font(pdf):
+    # Tayyor metrikalar nusxalanadi; faqat subset holati va fontTools obyekti yangi
+    # (fpdf chiqarishda shriftni joyida qisqartiradi, shuning uchun u hujjatlar orasida bo'lishilmaydi)
+    try:
+        proto, data = pdf_font()
+        font = copy.copy(proto)
+        font.i = len(pdf.fonts) + 1
+        font.ttfont = ttLib.TTFont(BytesIO(data), recalcTimestamp=False, lazy=True)
+        font.subset, font.missing_glyphs, font.biggest_size_pt = SubsetMap(font), [], 0
+        pdf.fonts[font.fontkey] = font
+    except (OSError, AttributeError, TypeError): # fpdf ichki tuzilishi boshqacha bo'lsa - odatiy yo'l
+        pdf.add_font("DejaVu", "", FONT_PATH)
+
+# Muqova shabloni: (shrift o'lchami, qator balandligi, matn, oldidan bo'sh joy); {..} info dan to'ldiriladi.
+# Bir marta tuziladi, har bir hujjatda faqat bajariladi
+PDF_COVER = (
+    (14, 8, "O'ZBEKISTON RESPUBLIKASI", 0),
+    (14, 8, "OLIY TA'LIM VAZIRLIGI", 0),
+    (14, 8, "{edu_place}", 0),
+    (24, 10, "{doc_type}", 40),
+    (16, 10, "Mavzu: {topic}", 10),
+)
+PDF_COVER_LINES = (("Bajardi", "student"), ("Guruh", "group"), ("Fakultet", "direction"), ("Fan", "subject"), ("Qabul qildi", "teacher"))
+NEXT_LINE = {"new_x": "LMARGIN", "new_y": "NEXT"}
+
+class PdfBuilder:
+    def __init__(self, info, doc_type="Referat", titles=None):
+        load_engines()
+        self.pdf = pdf = FPDF()
+        pdf.footer = functools.partial(pdf_footer, pdf) # Har sahifa ostida raqam
+        attach_pdf_font(pdf)
+        
+        pdf.add_page()
+        fields = {"edu_place": info['edu_place'].upper() if info['edu_place'] != "-" else "", "doc_type": doc_type.upper(), "topic": info['topic']}
+        for size, h, text, gap in PDF_COVER:
+            text = text.format(**fields)
+            if not text: continue
+            if gap: pdf.ln(gap)
+            pdf.set_font("DejaVu", "", size); pdf.multi_cell(0, h, text, align='C', **NEXT_LINE)
+        
+        pdf.ln(40); pdf.set_font("DejaVu", "", 14)
+        for label, key in PDF_COVER_LINES:
+            if info[key] != "-": pdf.set_x(100); pdf.cell(0, 10, f"{label}: {info[key]}", **NEXT_LINE)
+        pdf.add_page()
+
+    def add(self, item):
+        pdf = self.pdf
+        pdf.set_font("DejaVu", "", 16); pdf.multi_cell(0, 10, clean_text(item['title']), align='C', **NEXT_LINE); pdf.ln(5)
+        pdf.set_font("DejaVu", "", 12)
+        for para in clean_text(item['content']).split('\n'): # Har bir xatboshi alohida: katta matn bir blokda terilmaydi
+            pdf.multi_cell(0, 7, para, **NEXT_LINE)
+        pdf.ln(10)
+
+    def finish(self, out=None):
+        out = out or BytesIO(); out.write(self.pdf.output()); out.seek(0); return out
+
+def create_pdf(data_list, info, doc_type="Referat", out=None):
+    try: b = PdfBuilder(info, doc_type)
+    except Exception: return None
+    for item in data_list: b.add(item)
+    return b.finish(out)
+
+def make_builder(fmt, info, design="modern_blue", doc_type="Referat", titles=()):
+    if fmt == "pptx": return PptxBuilder(info, design, titles)
+    if fmt == "pdf": return PdfBuilder(info, doc_type, titles)
+    return DocxBuilder(info, doc_type, titles)
+
+RENDER_DIR = os.environ.get("RENDER_DIR") or tempfile.gettempdir() # Tayyor fayllar yuborilguncha shu yerda turadi
+RENDER_PREFIX = "edubot-"
+
+def write_render_file(fmt, write):
+    # Hujjat to'g'ridan-to'g'ri vaqtinchalik faylga yoziladi: ota jarayonga faqat yo'l qaytadi (bytes IPC orqali
+    # ko'chirilmaydi), Telegram'ga fayldan bo'laklab yuklanadi. write(f) bo'sh qaytsa - fayl yo'q
+    fd, path = tempfile.mkstemp(prefix=RENDER_PREFIX, suffix=f".{fmt}", dir=RENDER_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f: ok = write(f)
+    except BaseException:
+        os.remove(path); raise
+    if ok: return path
+    os.remove(path)
+
+def render_document(fmt, data_list, info, design="modern_blue", doc_type="Referat"):
+    # Ishchi jarayonda bajariladi: oddiy ma'lumot kiradi, fayl yo'li (yoki None) qaytadi
+    if fmt == "pptx": write = lambda f: create_presentation(data_list, info, design, f)
+    elif fmt == "pdf": write = lambda f: create_pdf(data_list, info, doc_type, f)
+    else: write = lambda f: create_document(data_list, info, doc_type, f)
+    return write_render_file(fmt, write)
+
+def remove_render_file(path):
+    try: os.remove(path)
+    except OSError: pass
+
+def prune_render_files(max_age=3600):
+    # Jarayon yiqilib qolsa yuborilmay qolgan fayllar
+    now = time.time()
+    with os.scandir(RENDER_DIR) as it:
+        for e in it:
+            if e.name.startswith(RENDER_PREFIX) and now - e.stat().st_mtime > max_age: remove_render_file(e.path)
+
+def render_stream(fmt, info, design, doc_type, titles, queue):
+    # Ishchi jarayonda: bo'limlar navbatdan (indeks, bo'lim) ko'rinishida keladi, tartib bilan qo'shiladi.
+    # None - hammasi keldi, False - bekor qilindi
+    b = make_builder(fmt, info, design, doc_type, titles)
+    pending, nxt = {}, 0
+    while True:
+        msg = queue.get(timeout=RENDER_STREAM_IDLE)
+        if msg is False: return None
+        if msg is None: break
+        i, item = msg; pending[i] = item
+        while nxt in pending: b.add(pending.pop(nxt)); nxt += 1
+    for i in sorted(pending): b.add(pending[i])
+    return write_render_file(fmt, b.finish)
+
+def warm_render_worker():
+    # Ishchi jarayon ochilganda kutubxonalar va shablonlar oldindan tayyorlanadi (birinchi ish kutib qolmaydi)
+    load_engines()
+    for design in PPTX_THEMES: pptx_template(design)
+    if os.path.exists(FONT_PATH): pdf_font()
+
+# Hujjatlar alohida jarayonlarda yasaladi, event loop bloklanmaydi
+render_pool = None
+render_sem = None
+render_pending = 0
+
+def render_busy():
+    return render_pending >= RENDER_WORKERS + RENDER_MAX_QUEUE
+
+async def render_async(fmt, data_list, info, design="modern_blue", doc_type="Referat"):
+    global render_pool, render_sem, render_pending
+    if render_pool is None:
+        render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"), initializer=warm_render_worker)
+        render_sem = asyncio.Semaphore(RENDER_WORKERS)
+    render_pending += 1
+    try:
+        async with render_sem:
+            with RENDER_SECONDS.labels(fmt, "full").time():
+                return await asyncio.get_running_loop().run_in_executor(render_pool, render_document, fmt, data_list, info, design, doc_type)
+    except BrokenProcessPool:
+        render_pool = None # Keyingi safar yangi pool ochiladi
+        raise
+    finally:
+        render_pending -= 1
+
+# Oqimli yig'ish uchun alohida pool: ish LLM javoblarini kutib turganda oddiy render navbatini band qilmaydi
+stream_pool = None
+stream_manager = None
+stream_workers = 0 # start_job_workers belgilaydi: shu jarayondagi ishchilar soni
+stream_opening = None
+
+def open_stream_pool(n):
+    # Manager() yangi jarayon main ni qayta import qilguncha kutadi: faqat event loop tashqarisida chaqiriladi
+    global stream_pool, stream_manager
+    ctx = multiprocessing.get_context("spawn")
+    manager = ctx.Manager()
+    pool_ = ProcessPoolExecutor(max_workers=n, mp_context=ctx, initializer=warm_render_worker)
+    if not stream_workers: # Ochilguncha to'xtatilgan
+        pool_.shutdown(wait=False); manager.shutdown(); return
+    stream_pool, stream_manager = pool_, manager
+
+def stream_pool_opened(fut):
+    global stream_opening
+    stream_opening = None
+    if fut.exception(): report_error("render", f"Stream pool error: {fut.exception()}")
+
+def start_stream_pool():
+    # Fonda ochiladi; tayyor bo'lguncha ishlar oddiy render_async bilan yasaladi
+    global stream_opening
+    if stream_pool or stream_opening or not stream_workers: return
+    stream_opening = asyncio.get_running_loop().run_in_executor(None, open_stream_pool, stream_workers)
+    stream_opening.add_done_callback(stream_pool_opened)
+
+class RenderStream:
+    # Bo'limlar yozilishi bilan hujjatga qo'shib boriladi: oxirida faqat saqlash qoladi
+    def __init__(self, fmt, info, design="modern_blue", doc_type="Referat"):
+        self.args = (fmt, info, design, doc_type)
+        self.queue = self.future = None
+        self.closed = False
+
+    def start(self, titles):
+        if stream_pool is None: return start_stream_pool()
+        try:
+            self.queue = stream_manager.Queue()
+            self.future = asyncio.get_running_loop().run_in_executor(stream_pool, render_stream, *self.args, list(titles), self.queue)
+        except Exception as e:
+            report_error("render", f"Stream start error: {e}"); self.future = None
 
-def create_pdf(data_list, info, doc_type="Referat"):
-    pdf = PDF()
-    try: pdf.add_font("DejaVu", "", FONT_PATH, uni=True); pdf.add_font("DejaVu", "B", FONT_PATH, uni=True)
-    except: return None
-    
-    pdf.set_font("DejaVu", "", 12); pdf.add_page()
-    pdf.set_font("DejaVu", "B", 14); pdf.cell(0, 8, "O'ZBEKISTON RESPUBLIKASI", ln=True, align='C'); pdf.cell(0, 8, "OLIY TA'LIM VAZIRLIGI", ln=True, align='C')
-    if info['edu_place'] != "-": pdf.multi_cell(0, 8, info['edu_place'].upper(), align='C')
-    
-    pdf.ln(40); pdf.set_font("DejaVu", "B", 24); pdf.cell(0, 10, doc_type.upper(), ln=True, align='C')
-    pdf.ln(10); pdf.set_font("DejaVu", "B", 16); pdf.multi_cell(0, 10, f"Mavzu: {info['topic']}", align='C')
-    
-    pdf.ln(40); pdf.set_font("DejaVu", "", 14); start_x = 100
-    def add_line(label, val):
-        if val != "-": pdf.set_x(start_x); pdf.set_font("DejaVu", "B", 14); pdf.cell(0, 10, f"{label}: {val}", ln=True)
-    add_line("Bajardi", info['student']); add_line("Guruh", info['group']); add_line("Fakultet", info['direction']); add_line("Fan", info['subject']); add_line("Qabul qildi", info['teacher'])
-    
-    pdf.add_page()
-    for item in data_list:
-        pdf.set_font("DejaVu", "B", 16); pdf.multi_cell(0, 10, clean_text(item['title']), align='C'); pdf.ln(5)
-        pdf.set_font("DejaVu", "", 12); pdf.multi_cell(0, 7, clean_text(item['content'])); pdf.ln(10)
-    
-    out = BytesIO(); out.write(pdf.output()); out.seek(0); return out
+    def section(self, i, item):
+        if self.future and not self.closed: self.queue.put((i, item))
+
+    async def result(self):
+        # Tayyor fayl yo'li yoki None - unda oddiy render_async ishlatiladi
+        if not self.future or self.closed: return None
+        self.closed = True
+        try:
+            with RENDER_SECONDS.labels(self.args[0], "stream").time():
+                self.queue.put(None)
+                return await self.future
+        except BrokenProcessPool:
+            reset_stream_pool(); return None
+        except Exception as e:
+            report_error("render", f"Stream render error: {e}"); return None
+
+    def abort(self):
+        if self.future and not self.closed:
+            self.closed = True
+            try: self.queue.put(False)
+            except Exception: pass
+
+def shutdown_stream_pool():
+    global stream_pool, stream_manager, stream_workers
+    stream_workers = 0
+    if stream_pool: stream_pool.shutdown(wait=False, cancel_futures=True); stream_pool = None
+    if stream_manager: stream_manager.shutdown(); stream_manager = None
+
+def reset_stream_pool():
+    # Yiqilgan pool yopiladi va fonda qaytadan ochiladi
+    global stream_workers
+    n = stream_workers
+    shutdown_stream_pool()
+    stream_workers = n; start_stream_pool()
+
+def shutdown_render_pool():
+    global render_pool
+    if render_pool: render_pool.shutdown(wait=False, cancel_futures=True); render_pool = None
+    shutdown_stream_pool()
 
 # ==============================================================================
 # AI MANTIQ (MATN YOZISH)
 # ==============================================================================
-async def call_groq(messages):
-    if not GROQ_API_KEYS: return None
-    for _ in range(5):
-        key = next(api_key_cycle)
-        for model in GROQ_MODELS:
+llm_semaphore = asyncio.Semaphore(LLM_GLOBAL_CONCURRENCY)
+
+# Har bir kalit uchun bitta doimiy klient (ulanishlar qayta ishlatiladi)
+llm_clients = {}
+
+def get_llm_client(key):
+    cl = llm_clients.get(key)
+    if cl is None:
+        load_llm()
+        cl = llm_clients[key] = AsyncOpenAI(api_key=key, base_url=GROQ_BASE_URL, timeout=LLM_TIMEOUT, max_retries=0)
+    return cl
+
+async def close_llm_clients():
+    for cl in llm_clients.values():
+        try: await cl.close()
+        except Exception as e: print(f"LLM close error: {e}")
+    llm_clients.clear()
+
+def parse_reset(val):
+    # Groq formati: "7.66s", "2m59.56s", "250ms"
+    if not val: return None
+    try: return float(val)
+    except ValueError: pass
+    total = 0.0
+    for num, unit in re.findall(r"([\d.]+)(ms|h|m|s)", val):
+        total += float(num) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total or None
+
+class LLMSlot:
+    # Kalit + model juftligining holati (yuklama, limit, dam olish)
+    def __init__(self, key, model):
+        self.key, self.model = key, model
+        self.inflight = 0; self.fails = 0; self.cooldown_until = 0.0
+        self.remaining = None
+
+    @property
+    def label(self): return f"...{self.key[-4:]}" # Metrikalarda kalit to'liq ko'rinmaydi
+
+    @property
+    def name(self): return f"{self.label}/{self.model}"
+
+    def count_tokens(self, usage):
+        if not usage: return
+        if isinstance(usage, dict): prompt, completion = usage.get("prompt_tokens"), usage.get("completion_tokens")
+        else: prompt, completion = usage.prompt_tokens, usage.completion_tokens
+        if prompt: LLM_TOKENS.labels(self.label, self.model, "prompt").inc(prompt)
+        if completion: LLM_TOKENS.labels(self.label, self.model, "completion").inc(completion)
+
+    def healthy(self, now): return self.cooldown_until <= now
+
+    def cool_down(self, seconds):
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def on_success(self, headers):
+        self.fails = 0
+        rem = headers.get("x-ratelimit-remaining-requests")
+        self.remaining = int(rem) if rem and rem.isdigit() else None
+        if self.remaining == 0 or headers.get("x-ratelimit-remaining-tokens") == "0":
+            self.cool_down(parse_reset(headers.get("x-ratelimit-reset-requests")) or parse_reset(headers.get("x-ratelimit-reset-tokens")) or LLM_COOLDOWN)
+
+    def on_error(self, e):
+        headers = getattr(getattr(e, "response", None), "headers", None) or {}
+        if isinstance(e, RateLimitError):
+            self.cool_down(parse_reset(headers.get("retry-after")) or parse_reset(headers.get("x-ratelimit-reset-requests")) or LLM_COOLDOWN)
+        elif isinstance(e, (AuthenticationError, PermissionDeniedError, NotFoundError)):
+            self.cool_down(3600) # Kalit yoki model ishlamaydi
+        else:
+            self.fails += 1
+            self.cool_down(min(LLM_COOLDOWN * 2 ** (self.fails - 1), 300))
+
+llm_slots = [LLMSlot(k, m) for k in GROQ_API_KEYS for m in GROQ_MODELS]
+
+def pick_slot(tried):
+    now = time.monotonic()
+    ok = [s for s in llm_slots if s.healthy(now) and s not in tried]
+    if not ok: return None
+    # Eng kam band, keyin asosiy model, keyin limiti ko'p qolgan
+    return min(ok, key=lambda s: (s.inflight, GROQ_MODELS.index(s.model), -(s.remaining or 0)))
+
+async def call_groq(messages, on_delta=None):
+    # on_delta berilsa javob oqim (stream) bo'lib keladi: on_delta(bo'lak), qayta urinishda on_delta(None)
+    if not llm_slots: return None
+    load_llm() # except bloklaridagi xato turlari uchun ham
+    async with llm_semaphore:
+        tried, rejected = set(), set() # rejected: shu so'rovni rad etgan juftliklar (400)
+        for _ in range(LLM_MAX_ATTEMPTS):
+            slot = pick_slot(tried | rejected)
+            if slot is None:
+                # Hamma juftlik dam olyapti: eng yaqinini kutamiz
+                wait = min(s.cooldown_until for s in llm_slots if s not in rejected) - time.monotonic()
+                if wait > LLM_TIMEOUT: return None
+                await asyncio.sleep(max(wait, 0.1)); tried.clear(); continue
+            tried.add(slot); slot.inflight += 1
+            t0, outcome = time.monotonic(), "ok"
             try:
-                cl = AsyncOpenAI(api_key=key, base_url="https://api.groq.com/openai/v1")
-                resp = await cl.chat.completions.create(model=model, messages=messages, temperature=0.7, max_tokens=2500)
-                await cl.close()
-                return resp.choices[0].message.content
-            except: continue
+                raw = await get_llm_client(slot.key).chat.completions.with_raw_response.create(model=slot.model, messages=messages, temperature=0.7, max_tokens=2500, stream=on_delta is not None)
+                slot.on_success(raw.headers)
+                if on_delta is None:
+                    res = raw.parse(); slot.count_tokens(res.usage)
+                    return res.choices[0].message.content
+                parts = []
+                try:
+                    async for chunk in raw.parse():
+                        piece = chunk.choices[0].delta.content if chunk.choices else None
+                        if piece: parts.append(piece); on_delta(piece)
+                        # Groq oqimda sarfni oxirgi bo'lakdagi x_groq.usage da beradi
+                        slot.count_tokens(getattr(chunk, "usage", None) or (getattr(chunk, "x_groq", None) or {}).get("usage"))
+                except Exception:
+                    on_delta(None); raise
+                return "".join(parts)
+            except BadRequestError as e:
+                # Faqat shu model rad etgan bo'lishi mumkin (masalan, eskirgan model): juftlik dam oladi, boshqasi sinaladi
+                outcome = "bad_request"
+                slot.on_error(e); rejected.add(slot)
+                report_error("llm", f"LLM so'rov xatosi ({slot.name}): {e}")
+                if len(rejected) == len(llm_slots): return None # Hammasi rad etdi: so'rovning o'zi noto'g'ri
+            except Exception as e:
+                outcome = "rate_limit" if isinstance(e, RateLimitError) else "error"
+                slot.on_error(e)
+                report_error("llm", f"LLM xato ({slot.name}): {type(e).__name__}")
+            finally:
+                slot.inflight -= 1
+                LLM_SECONDS.labels(slot.label, slot.model, outcome).observe(time.monotonic() - t0)
     return None
 
-async def generate_full_content(topic, pages, doc_type, custom_plan, status_msg):
-    async def progress(pct, text):
-        if status_msg:
-            try: await status_msg.edit_text(f"⏳ <b>Jarayon: {pct}%</b>\n\n⚙️ {text}", parse_mode="HTML")
-            except: pass
+def outline_size(pages, doc_type):
+    return pages if doc_type == "taqdimot" else max(6, int(pages/2) + 2)
+
+def fallback_outline(topic, n):
+    # Reja chiqmasa (LLM javobi o'qilmadi) standart sarlavhalar
+    return [f"{topic} - {i}-qism" for i in range(1, n+1)]
+
+def trim_outline(titles, n):
+    # Uzunroq reja qisqartirilganda xulosa (oxirgi band) saqlab qolinadi
+    return titles if len(titles) <= n else titles[:n-1] + titles[-1:]
+
+def section_prompt(topic, doc_type, title):
+    if doc_type == "taqdimot":
+        return f"Mavzu: {topic}. Slayd: {title}. Ushbu slayd uchun to'liq, 150-200 so'zdan iborat, punktlarga bo'lingan mazmunli matn yoz. Kirish so'zlarisiz."
+    return f"Mavzu: {topic}. Bob: {title}. Shu bob uchun kamida 800 so'zli, ilmiy uslubda, kengaytirilgan va batafsil matn yoz. Paragraflarga bo'l."
 
-    await progress(5, "Reja tuzilmoqda...")
+async def make_outline(topic, pages, doc_type, custom_plan):
+    num = outline_size(pages, doc_type)
     if doc_type == "taqdimot":
         prompt = f"Mavzu: {topic}. {pages} ta slayd uchun qiziqarli sarlavhalar (JSON array). Faqat JSON."
         res = await call_groq([{"role":"system","content":"JSON only."}, {"role":"user","content":prompt}])
-        titles = extract_json_array(res)
-        if not titles: titles = [f"{topic} - {i}-qism" for i in range(1, pages+1)]
-        
-        data = []
-        for i, t in enumerate(titles[:pages]):
-            await progress(10 + int((i/len(titles))*85), f"Slayd yozilmoqda: {t}")
-            p_text = f"Mavzu: {topic}. Slayd: {t}. Ushbu slayd uchun to'liq, 150-200 so'zdan iborat, punktlarga bo'lingan mazmunli matn yoz. Kirish so'zlarisiz."
-            content = await call_groq([{"role":"user", "content":p_text}])
-            data.append({"title": t, "content": content or "..."})
-        return data
-    else: 
-        num = max(6, int(pages/2) + 2)
-        prompt = f"Mavzu: {topic}. {num} ta bobdan iborat reja."
-        if custom_plan != "-": prompt += f" Reja: {custom_plan}"
-        res = await call_groq([{"role":"user", "content":prompt}])
-        chapters = [x.strip() for x in res.split('\n') if len(x)>5][:num]
-        
-        data = []
-        for i, ch in enumerate(chapters):
-            await progress(10 + int((i/len(chapters))*85), f"Bob yozilmoqda: {ch}")
-            p_text = f"Mavzu: {topic}. Bob: {ch}. Shu bob uchun kamida 800 so'zli, ilmiy uslubda, kengaytirilgan va batafsil matn yoz. Paragraflarga bo'l."
-            content = await call_groq([{"role":"user", "content":p_text}])
-            data.append({"title": ch, "content": content or "..."})
-        return data
+        titles = [str(t) for t in extract_json_array(res or "")]
+        if not titles: titles = fallback_outline(topic, pages)
+        return titles[:num]
+    prompt = f"Mavzu: {topic}. {num} ta bobdan iborat reja."
+    if custom_plan != "-": prompt += f" Reja: {custom_plan}"
+    res = await call_groq([{"role":"user", "content":prompt}])
+    return [x.strip() for x in (res or "").split('\n') if len(x)>5][:num]
+
+# Holat xabari har chat uchun PROGRESS_INTERVAL soniyada ko'pi bilan bir marta tahrirlanadi
+progress_next_edit = {}
+
+class ProgressReporter:
+    # Yangilanishlarni yig'ib, "Jarayon: N%" xabarini kamdan-kam tahrirlaydi
+    def __init__(self, status_msg, doc_type):
+        self.msg, self.doc_type = status_msg, doc_type
+        self.chat_id = getattr(status_msg, "chat_id", id(status_msg))
+        self.expected = 175 if doc_type == "taqdimot" else 800 # Bo'limdagi taxminiy so'zlar
+        self.stage, self.pct = "", 0
+        self.titles, self.words, self.finished = [], {}, set()
+        self.task, self.last_text = None, None
+
+    def set_stage(self, text, pct):
+        self.stage, self.pct = text, pct; self.touch()
+
+    def start_sections(self, titles):
+        self.titles = list(titles); self.stage = ""; self.touch()
+
+    def add_words(self, title, piece):
+        if piece is None: self.words[title] = 0 # Qayta urinish: hisob boshidan
+        else: self.words[title] = self.words.get(title, 0) + piece.count(" ") + piece.count("\n")
+        self.touch()
+
+    def section_done(self, title):
+        self.finished.add(title); self.touch()
+
+    def render(self):
+        if not self.titles: return f"⏳ <b>Jarayon: {self.pct}%</b>\n\n⚙️ {self.stage}"
+        total = len(self.titles)
+        part = sum(1 if t in self.finished else min(self.words.get(t, 0) / self.expected, 0.9) for t in self.titles)
+        pct = 10 + int(85 * part / total)
+        label = "Slaydlar" if self.doc_type == "taqdimot" else "Boblar"
+        return (f"⏳ <b>Jarayon: {pct}%</b>\n\n⚙️ {label} yozilmoqda: {len(self.finished)}/{total} tayyor\n"
+                f"✍️ {sum(self.words.values()):,} so'z yozildi")
+
+    def touch(self):
+        if self.msg and self.task is None: self.task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        send_priority.set(PRIO_PROGRESS) # Foydalanuvchiga javoblar oldinroq ketadi
+        try:
+            while True:
+                wait = progress_next_edit.get(self.chat_id, 0) - time.monotonic()
+                if wait > 0: await asyncio.sleep(wait)
+                text = self.render()
+                if text == self.last_text: return
+                progress_next_edit[self.chat_id] = time.monotonic() + PROGRESS_INTERVAL
+                try: await self.msg.edit_text(text, parse_mode="HTML"); self.last_text = text
+                except TelegramRetryAfter as e: progress_next_edit[self.chat_id] = time.monotonic() + e.retry_after
+                except TelegramBadRequest as e:
+                    if "not modified" in str(e): self.last_text = text # Matn allaqachon shu: qayta yuborilmaydi
+                    else: report_error("job", f"Progress edit error: {e}"); return
+        finally:
+            self.task = None
+
+    async def close(self):
+        if self.task: self.task.cancel()
+        # Muddati o'tgan chatlar o'chiriladi (lug'at faqat so'nggi tahrirlar bilan qoladi)
+        now = time.monotonic()
+        for chat_id in [k for k, t in progress_next_edit.items() if t <= now]: del progress_next_edit[chat_id]
+
+async def write_sections(topic, doc_type, titles, reporter=None, ready=None, sink=None):
+    # Bo'limlar parallel yoziladi, natija esa asl tartibda qaytadi; sink har bir tayyor bo'limni darhol oladi
+    ready = ready or {}
+    job_sem = asyncio.Semaphore(LLM_JOB_CONCURRENCY)
+    if reporter: reporter.start_sections(titles)
+    if sink: sink.start(titles)
+    async def write(i, t):
+        content = ready.get(t)
+        if content is None:
+            async with job_sem:
+                on_delta = (lambda piece: reporter.add_words(t, piece)) if reporter else None
+                content = await call_groq([{"role":"user", "content":section_prompt(topic, doc_type, t)}], on_delta)
+        elif reporter: reporter.add_words(t, content)
+        if reporter: reporter.section_done(t)
+        item = {"title": t, "content": content or "..."}
+        if sink: sink.section(i, item)
+        return item
+    return list(await asyncio.gather(*(write(i, t) for i, t in enumerate(titles))))
+
+async def generate_full_content(topic, pages, doc_type, custom_plan, status_msg, prefetched=None, sink=None):
+    reporter = ProgressReporter(status_msg, doc_type)
+    try:
+        prefetched = prefetched or {}
+        if prefetched.get("outline"):
+            outline, n = prefetched["outline"], outline_size(pages, doc_type)
+            # Standart sarlavhalar qisqartirilmaydi (1..9 + 20-qism bo'lib qolardi), kerakli hajmda qayta raqamlanadi
+            titles = fallback_outline(topic, n) if outline == fallback_outline(topic, len(outline)) else trim_outline(outline, n)
+        else:
+            reporter.set_stage("Reja tuzilmoqda...", 5)
+            titles = await make_outline(topic, pages, doc_type, custom_plan)
+        return await write_sections(topic, doc_type, titles, reporter, prefetched.get("sections"), sink)
+    finally:
+        await reporter.close()
+
+# ==============================================================================
+# OLDINDAN YOZISH (USER ANKETANI TO'LDIRAYOTGANDA)
+# ==============================================================================
+prefetches = {} # uid -> {"sig": (mavzu, tur, reja), "task": Task}
+
+async def prefetch_content(topic, doc_type, custom_plan):
+    # Eng katta hajm uchun reja tuziladi: kichikroq hajmda u qisqartiriladi
+    outline = await make_outline(topic, max(DOC_LENGTHS[doc_type]), doc_type, custom_plan)
+    first = await write_sections(topic, doc_type, outline[:PREFETCH_SECTIONS])
+    return {"outline": outline, "sections": {x['title']: x['content'] for x in first if x['content'] != "..."}}
+
+async def start_prefetch(uid, topic, doc_type, custom_plan):
+    cancel_prefetch(uid)
+    if not PREFETCH_ENABLED or not topic: return
+    # Kesh allaqachon bor bo'lsa, behuda so'rov yubormaymiz
+    keys = [content_cache_key(topic, n, doc_type, custom_plan) for n in DOC_LENGTHS[doc_type]]
+    try:
+        async with pool.acquire() as conn:
+            if await conn.fetchval("SELECT 1 FROM content_cache WHERE key = ANY($1) LIMIT 1", keys): return
+    except Exception as e: report_error("prefetch", f"Prefetch check error: {e}")
+    async def run(): return await asyncio.wait_for(prefetch_content(topic, doc_type, custom_plan), PREFETCH_TIMEOUT)
+    task = asyncio.create_task(run())
+    task.add_done_callback(prefetch_done)
+    entry = prefetches[uid] = {"sig": (topic, doc_type, custom_plan), "task": task}
+    # Ishlatilmay qolsa, ma'lum vaqtdan keyin tashlab yuboriladi
+    asyncio.get_running_loop().call_later(PREFETCH_TTL, lambda: prefetches.get(uid) is entry and cancel_prefetch(uid))
+
+def prefetch_done(task):
+    # Natija keyin prefetch_result orqali olinadi, xato esa shu yerda qayd etiladi (jim yutilmaydi)
+    if task.cancelled() or not task.exception(): return
+    e = task.exception()
+    report_error("prefetch", f"Prefetch error: {type(e).__name__}: {e}")
+
+def cancel_prefetch(uid):
+    entry = prefetches.pop(uid, None)
+    if entry: entry["task"].cancel()
+
+def take_prefetch(uid, topic, doc_type, custom_plan):
+    entry = prefetches.pop(uid, None)
+    if not entry: return None
+    if entry["sig"] != (topic, doc_type, custom_plan):
+        entry["task"].cancel(); return None
+    return entry["task"]
+
+def prefetch_result(task):
+    if task.cancelled() or task.exception(): return None
+    return task.result()
+
+# ==============================================================================
+# KESH (BIR XIL MAVZULAR UCHUN TAYYOR MATN)
+# ==============================================================================
+cache_stats = {"hit_local": 0, "hit_db": 0, "miss": 0}
+local_cache = OrderedDict() # key -> (muddati, variantlar)
+
+def normalize_text(text):
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", (text or "").lower())).strip()
+
+def content_cache_key(topic, pages, dtype, plan):
+    raw = json.dumps([normalize_text(topic), dtype, pages, normalize_text(plan)], ensure_ascii=False)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+async def cache_lookup(key):
+    # (tanlangan variant yoki None, mavjud variantlar soni)
+    hit, source = local_cache.get(key), "hit_local"
+    if hit and hit[0] > time.monotonic():
+        local_cache.move_to_end(key); variants = hit[1]
+    else:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                UPDATE content_cache SET hits = hits + 1, last_hit = now()
+                WHERE key = $1 AND created_at > now() - make_interval(secs => $2) RETURNING data
+            """, key, CACHE_TTL_DAYS * 86400)
+        variants, source = [r['data'] for r in rows], "hit_db"
+        if variants: remember_local(key, variants)
+    if len(variants) < CACHE_VARIANTS: # Yangi variant yozdiramiz
+        cache_stats["miss"] += 1; return None, len(variants)
+    cache_stats[source] += 1
+    return random.choice(variants), len(variants)
+
+def remember_local(key, variants):
+    local_cache[key] = (time.monotonic() + min(CACHE_TTL_DAYS * 86400, 3600), variants); local_cache.move_to_end(key)
+    while len(local_cache) > CACHE_LOCAL_SIZE: local_cache.popitem(last=False)
+
+async def cache_store(key, variant, data):
+    async with pool.acquire() as conn:
+        await conn.execute("""
+            INSERT INTO content_cache (key, variant, data) VALUES ($1, $2, $3)
+            ON CONFLICT (key, variant) DO UPDATE SET data = $3, created_at = now(), last_hit = now()
+        """, key, variant, data)
+    local_cache.pop(key, None)
+
+async def prune_content_cache():
+    # Muddati o'tganlar va eng kam ishlatilganlar (LRU) o'chiriladi
+    async with pool.acquire() as conn:
+        await conn.execute("DELETE FROM content_cache WHERE created_at < now() - make_interval(secs => $1)", CACHE_TTL_DAYS * 86400)
+        await conn.execute("DELETE FROM sent_files WHERE last_used < now() - make_interval(secs => $1)", CACHE_TTL_DAYS * 86400)
+        await conn.execute("""
+            DELETE FROM content_cache WHERE (key, variant) IN (
+                SELECT key, variant FROM content_cache ORDER BY last_hit DESC OFFSET $1
+            )
+        """, CACHE_MAX_ROWS)
+
+# Tayyor fayllar: hujjat kaliti (matn + format + dizayn + muqova) -> Telegram file_id.
+# DOC_VERSION dizayn/maket o'zgarganda oshiriladi, eski nusxalar qayta yuborilmaydi
+DOC_VERSION = 1
+
+def document_key(fmt, design, doc_type, info, content):
+    raw = json.dumps([DOC_VERSION, fmt, design, doc_type, info, content], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+async def sent_file_lookup(key):
+    async with pool.acquire() as conn:
+        return await conn.fetchval("UPDATE sent_files SET last_used = now() WHERE key = $1 RETURNING file_id", key)
+
+async def sent_file_store(key, fmt, document):
+    async with pool.acquire() as conn:
+        await conn.execute("""
+            INSERT INTO sent_files (key, file_id, fmt, size) VALUES ($1, $2, $3, $4)
+            ON CONFLICT (key) DO UPDATE SET file_id = $2, size = $4, last_used = now()
+        """, key, document.file_id, fmt, document.file_size)
+
+async def sent_file_forget(key):
+    async with pool.acquire() as conn: await conn.execute("DELETE FROM sent_files WHERE key = $1", key)
+
+async def get_content(topic, pages, doc_type, custom_plan, status_msg, prefetched=None, sink=None):
+    key = content_cache_key(topic, pages, doc_type, custom_plan)
+    try: data, n = await cache_lookup(key)
+    except Exception as e:
+        report_error("cache", f"Cache error: {e}"); data, n = None, CACHE_VARIANTS
+    if data: return data
+    data = await generate_full_content(topic, pages, doc_type, custom_plan, status_msg, prefetched, sink)
+    # Chala chiqqan (xato bo'lgan bo'limli) matn keshga yozilmaydi
+    if data and n < CACHE_VARIANTS and all(x['content'] != "..." for x in data):
+        try: await cache_store(key, n, data)
+        except Exception as e: report_error("cache", f"Cache error: {e}")
+    return data
+
+# ==============================================================================
+# TELEGRAMGA YUBORISH (UMUMIY NAVBAT VA LIMITLAR)
+# ==============================================================================
+PRIO_USER, PRIO_PROGRESS, PRIO_BULK = 0, 1, 2 # Kichik raqam birinchi yuboriladi
+send_priority = contextvars.ContextVar("send_priority", default=PRIO_USER)
+
+class SendScheduler(BaseRequestMiddleware):
+    # Bot orqali ketadigan barcha so'rovlar shu yerdan o'tadi:
+    # umumiy token-bucket, har chat uchun limit, ustuvorlik va 429 (RetryAfter) da kutib qayta urinish
+    LIMITED = (SendMessage, SendPhoto, SendDocument, SendMediaGroup, CopyMessage, ForwardMessage,
+               EditMessageText, EditMessageCaption, EditMessageReplyMarkup)
+
+    def __init__(self, rate, chat_rate, chat_burst):
+        self.rate, self.chat_rate, self.chat_burst = rate, chat_rate, chat_burst
+        self.tokens, self.updated = rate, time.monotonic()
+        self.waiters, self.seq, self.pump_task = [], itertools.count(), None
+        self.chats = {} # chat_id -> [tokens, vaqt]
+        self.stats = {"sent": 0, "retry_after": 0, "errors": 0, "wait_total": 0.0}
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate); self.updated = now
+
+    async def acquire(self, prio):
+        self.refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1; return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (prio, next(self.seq), fut))
+        if self.pump_task is None: self.pump_task = asyncio.create_task(self.pump())
+        await fut
+
+    async def pump(self):
+        try:
+            while self.waiters:
+                self.refill()
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate); continue
+                _, _, fut = heapq.heappop(self.waiters)
+                if not fut.done(): self.tokens -= 1; fut.set_result(None)
+        finally:
+            self.pump_task = None
+
+    async def wait_chat(self, chat_id):
+        if chat_id is None: return
+        while True:
+            now = time.monotonic()
+            tokens, updated = self.chats.get(chat_id, (self.chat_burst, now))
+            tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate)
+            if tokens >= 1:
+                self.chats[chat_id] = [tokens - 1, now]; break
+            self.chats[chat_id] = [tokens, now]
+            await asyncio.sleep((1 - tokens) / self.chat_rate)
+        if len(self.chats) > 10000: # To'lgan (uzoq jim turgan) chatlarni unutamiz
+            self.chats = {k: v for k, v in self.chats.items() if now - v[1] < self.chat_burst / self.chat_rate}
+
+    def pause_chat(self, chat_id, seconds):
+        if chat_id is None:
+            self.tokens = 1 - seconds * self.rate # Umumiy pauza
+        else:
+            self.chats[chat_id] = [1 - seconds * self.chat_rate, time.monotonic()]
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, self.LIMITED): return await make_request(bot, method)
+        chat_id, name = getattr(method, "chat_id", None), type(method).__name__
+        for attempt in range(TG_MAX_RETRIES + 1):
+            t0 = time.monotonic()
+            await self.wait_chat(chat_id)
+            await self.acquire(send_priority.get())
+            t1 = time.monotonic()
+            self.stats["wait_total"] += t1 - t0; TG_WAIT_SECONDS.observe(t1 - t0)
+            try:
+                res = await make_request(bot, method)
+                self.stats["sent"] += 1
+                return res
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1; TG_RETRY_AFTER.labels(name).inc()
+                print(f"Telegram 429 ({name}, chat {chat_id}): {e.retry_after}s")
+                self.pause_chat(chat_id, e.retry_after)
+                if attempt == TG_MAX_RETRIES: raise
+            except TelegramAPIError:
+                self.stats["errors"] += 1; TG_ERRORS.labels(name).inc(); raise
+            finally:
+                TG_SECONDS.labels(name).observe(time.monotonic() - t1)
+
+    def snapshot(self):
+        return {**self.stats, "queued": len(self.waiters), "chats": len(self.chats)}
+
+send_scheduler = SendScheduler(TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST)
+
+def make_bot():
+    bot = Bot(token=BOT_TOKEN)
+    bot.session.middleware(send_scheduler)
+    return bot
+
+# ==============================================================================
+# HISOBOT EKSPORTI (OQIMLI, XOTIRA O'SMAYDI)
+# ==============================================================================
+EXPORT_SPOOL_SIZE = int(os.environ.get("EXPORT_SPOOL_MB", 8)) * 1024 * 1024 # Shundan katta fayl diskka tushadi
+EXPORT_FETCH = 2000 # Kursor bir martada olib keladigan qatorlar
+
+class SpooledInputFile(InputFile):
+    # Vaqtinchalik fayldan bo'laklab yuklanadi (qayta yuborishda boshidan o'qiladi)
+    def __init__(self, file, filename):
+        super().__init__(filename=filename)
+        self.file = file
+
+    async def read(self, bot):
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size): yield chunk
+
+async def export_history(date_from=None, date_to=None, dtype=None):
+    # Kursor orqali qatorlar oqim bilan gzip CSV ga yoziladi; (fayl, qatorlar soni) qaytaradi
+    where, args = [], []
+    if date_from: args.append(date_from); where.append(f"h.date >= ${len(args)}::date")
+    if date_to: args.append(date_to); where.append(f"h.date < ${len(args)}::date + 1")
+    if dtype: args.append(dtype); where.append(f"h.doc_type = ${len(args)}")
+    query = f"""
+        SELECT to_char(h.date, 'YYYY-MM-DD HH24:MI'), u.full_name, u.username, h.user_id, h.doc_type, h.topic, h.student, h.uni, h.faculty, h.grp, h.teacher
+        FROM history h LEFT JOIN users u ON h.user_id = u.user_id
+        {"WHERE " + " AND ".join(where) if where else ""} ORDER BY h.id
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    rows = 0
+    with gzip.GzipFile(fileobj=spool, mode="wb", filename="report.csv") as gz:
+        out = TextIOWrapper(gz, encoding="utf-8-sig", newline="")
+        writer = csv.writer(out)
+        writer.writerow(["Sana", "Foydalanuvchi", "Username", "ID", "Turi", "Mavzu", "Talaba", "Universitet", "Fakultet", "Guruh", "O'qituvchi"])
+        async with pool.acquire() as conn:
+            async with conn.transaction(): # Kursor faqat tranzaksiya ichida ishlaydi
+                async for r in conn.cursor(query, *args, prefetch=EXPORT_FETCH):
+                    writer.writerow(r.values()); rows += 1
+        out.flush(); out.detach() # gzip faylini TextIOWrapper yopmasin
+    return spool, rows
+
+def export_period_kb():
+    today = datetime.now().date()
+    d = lambda days: (today - timedelta(days=days)).strftime("%Y%m%d")
+    kb = InlineKeyboardBuilder()
+    kb.button(text="📅 Bugun", callback_data=f"logp_{d(0)}_0")
+    kb.button(text="📅 7 kun", callback_data=f"logp_{d(6)}_0")
+    kb.button(text="📅 30 kun", callback_data=f"logp_{d(29)}_0")
+    kb.button(text="♾ Hammasi", callback_data="logp_0_0")
+    kb.button(text="🗓 Sana oralig'i", callback_data="logp_range")
+    kb.button(text="🔙 Orqaga", callback_data="admin_home")
+    kb.adjust(2, 2, 1, 1)
+    return kb.as_markup()
+
+def export_type_kb(date_from, date_to):
+    kb = InlineKeyboardBuilder()
+    for text, t in (("📦 Hammasi", "all"), ("📊 Taqdimot", "taqdimot"), ("📑 Referat", "referat")):
+        kb.button(text=text, callback_data=f"logx_{date_from}_{date_to}_{t}")
+    kb.adjust(1)
+    return kb.as_markup()
 
 # ==============================================================================
 # HANDLERS (BUYRUQLAR) - TUZATILGAN VERSIYA
@@ -415,7 +1676,23 @@ skip_kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="➡
 class Form(StatesGroup):
     type = State(); topic = State(); plan = State(); student = State(); uni = State(); fac = State(); grp = State(); subj = State(); teach = State(); design = State(); len = State(); format = State()
 class PayState(StatesGroup): screenshot = State(); amount = State()
-class AdminState(StatesGroup): bc_msg=State(); bc_id=State(); bc_text=State(); add_adm=State(); price_val=State(); bc_one_msg=State(); bc_one_id=State(); block_uid=State(); unblock_uid=State()
+class AdminState(StatesGroup): bc_msg=State(); bc_id=State(); bc_text=State(); add_adm=State(); price_val=State(); bc_one_msg=State(); bc_one_id=State(); block_uid=State(); unblock_uid=State(); log_range=State()
+
+class UserMiddleware(BaseMiddleware):
+    # Har bir update uchun user bir marta (keshdan) olinadi, bloklanganlar shu yerda to'xtatiladi
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user and pool:
+            u = await get_user(user.id)
+            if u and u['is_blocked'] and not await is_admin(user.id):
+                if isinstance(event, CallbackQuery): await event.answer("🚫 Siz bloklangansiz.", show_alert=True)
+                else: await event.answer("🚫 <b>Sizning hisobingiz bloklangan.</b>\nAdmin bilan bog'laning.", parse_mode="HTML")
+                return
+            data["db_user"] = u
+        return await handler(event, data)
+
+router.message.outer_middleware(UserMiddleware())
+router.callback_query.outer_middleware(UserMiddleware())
 
 # --- 1. ENG MUHIMI: BEKOR QILISH (ENG TEPADA TURISHI SHART) ---
 @router.message(F.text == "❌ Bekor qilish")
@@ -425,7 +1702,7 @@ async def cancel_all(m: types.Message, state: FSMContext):
         await m.answer("Hozir hech qanday jarayon ketmayapti.", reply_markup=main_kb)
         return
 
-    await state.clear()
+    await state.clear(); cancel_prefetch(m.from_user.id)
     await m.answer("✅ Jarayon bekor qilindi.", reply_markup=main_kb)
 
 # --- START ---
@@ -437,20 +1714,15 @@ async def start(m: types.Message, command: CommandObject):
             try: referrer_id = int(command.args)
             except: pass
         
-        is_new = await create_user(m.from_user.id, m.from_user.username, m.from_user.full_name, referrer_id)
-        
-        # Bloklanganlikni tekshirish
-        u = await get_user(m.from_user.id)
-        if u and u['is_blocked']:
-            await m.answer("🚫 <b>Sizning hisobingiz bloklangan.</b>\nAdmin bilan bog'laning.", parse_mode="HTML")
-            return
+        # Bloklanganlar UserMiddleware'da to'xtatiladi
+        _, is_new = await create_user(m.from_user.id, m.from_user.username, m.from_user.full_name, referrer_id)
 
         txt = "👋 <b>Assalomu alaykum!</b>\nMen professional akademik yordamchiman.\nReferat, Slayd va Mustaqil ishlarni yuqori sifatda tayyorlayman."
         if is_new and referrer_id:
             await m.bot.send_message(referrer_id, f"🎉 <b>Tabriklaymiz!</b>\nSiz do'stingizni taklif qildingiz va hisobingizga <b>{REFERRAL_BONUS:,} so'm</b> qo'shildi!", parse_mode="HTML")
             
         await m.answer(txt, parse_mode="HTML", reply_markup=main_kb)
-    except: pass
+    except Exception as e: report_error("handler", f"Start error: {e}")
 
 # --- MENYU BUYRUQLARI ---
 @router.message(F.text == "📞 Yordam")
@@ -466,8 +1738,8 @@ async def help_cmd(m: types.Message):
     await m.answer(txt, parse_mode="HTML", reply_markup=main_kb)
 
 @router.message(F.text == "💰 Balans & Referal")
-async def balance(m: types.Message):
-    u = await get_user(m.from_user.id)
+async def balance(m: types.Message, db_user=None):
+    u = db_user
     if u: 
         link = await create_start_link(m.bot, str(m.from_user.id), encode=False)
         txt = (
@@ -482,10 +1754,10 @@ async def balance(m: types.Message):
 
 # --- HUJJAT YARATISH JARAYONI ---
 @router.message(F.text.in_(["📊 Taqdimot", "📝 Mustaqil ish", "📑 Referat"]))
-async def start_order(m: types.Message, state: FSMContext):
-    u = await get_user(m.from_user.id)
-    if not u or u.get('is_blocked', 0): return await m.answer("🚫 Siz bloklangansiz.")
+async def start_order(m: types.Message, state: FSMContext, db_user=None):
+    if not db_user: return await m.answer("🚫 Siz bloklangansiz.")
     dtype = "taqdimot" if "Taqdimot" in m.text else "referat"
+    cancel_prefetch(m.from_user.id)
     await state.update_data(dtype=dtype)
     await m.answer("📝 <b>Mavzuni yozing:</b>", parse_mode="HTML", reply_markup=cancel_kb); await state.set_state(Form.topic)
 
@@ -496,9 +1768,13 @@ async def get_topic(m: types.Message, state: FSMContext):
     await state.set_state(Form.plan)
 
 @router.callback_query(F.data == "skip", Form.plan)
-async def skip_p(c: CallbackQuery, state: FSMContext): await state.update_data(plan="-"); await c.message.answer("👤 <b>Ism-Familiya:</b>", parse_mode="HTML"); await state.set_state(Form.student)
+async def skip_p(c: CallbackQuery, state: FSMContext):
+    d = await state.update_data(plan="-"); await start_prefetch(c.from_user.id, d.get('topic'), d['dtype'], "-")
+    await c.message.answer("👤 <b>Ism-Familiya:</b>", parse_mode="HTML"); await state.set_state(Form.student)
 @router.message(Form.plan)
-async def get_plan(m: types.Message, state: FSMContext): await state.update_data(plan=m.text); await m.answer("👤 <b>Ism-Familiya:</b>", parse_mode="HTML"); await state.set_state(Form.student)
+async def get_plan(m: types.Message, state: FSMContext):
+    d = await state.update_data(plan=m.text); await start_prefetch(m.from_user.id, d.get('topic'), d['dtype'], m.text)
+    await m.answer("👤 <b>Ism-Familiya:</b>", parse_mode="HTML"); await state.set_state(Form.student)
 @router.message(Form.student)
 async def get_student(m: types.Message, state: FSMContext): await state.update_data(student=m.text); await m.answer("🏫 <b>O'qish joyi (Universitet):</b>", parse_mode="HTML", reply_markup=skip_kb); await state.set_state(Form.uni)
 @router.callback_query(F.data == "skip", Form.uni)
@@ -538,7 +1814,7 @@ async def get_teach(m: types.Message, state: FSMContext):
 async def sel_design(c: CallbackQuery, state: FSMContext):
     await state.update_data(design=c.data[2:], fmt="pptx")
     kb = InlineKeyboardBuilder()
-    for i in [10, 15, 20]:
+    for i in DOC_LENGTHS['taqdimot']:
         p = await get_price(f"pptx_{i}")
         kb.button(text=f"{i} slayd ({p//1000}k)", callback_data=f"len_{i}_{p}")
     kb.adjust(2)
@@ -549,7 +1825,7 @@ async def sel_design(c: CallbackQuery, state: FSMContext):
 async def sel_fmt(c: CallbackQuery, state: FSMContext):
     await state.update_data(fmt=c.data[4:])
     kb = InlineKeyboardBuilder()
-    for i in [15, 20, 30]:
+    for i in DOC_LENGTHS['referat']:
         p = await get_price(f"docx_{i}")
         kb.button(text=f"{i} bet ({p//1000}k)", callback_data=f"len_{i}_{p}")
     kb.adjust(2)
@@ -579,61 +1855,63 @@ async def back_to_fmt_handler(c: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "cancel_gen")
 async def cancel_gen_btn(c: CallbackQuery, state: FSMContext):
-    await state.clear(); await c.message.delete(); await c.message.answer("❌ Bekor qilindi.", reply_markup=main_kb)
+    await state.clear(); cancel_prefetch(c.from_user.id); await c.message.delete(); await c.message.answer("❌ Bekor qilindi.", reply_markup=main_kb)
 
 @router.callback_query(F.data.startswith("len_"), Form.len)
-async def generate(c: CallbackQuery, state: FSMContext):
+async def generate(c: CallbackQuery, state: FSMContext, db_user=None):
     await c.message.delete()
     try:
-        _, page_str, cost_str = c.data.split("_"); pages=int(page_str); cost=int(cost_str)
-        uid = c.from_user.id; u = await get_user(uid)
+        pages = int(c.data.split("_")[1])
+        uid = c.from_user.id; u = db_user
         d = await state.get_data()
         
         # FORMATNI TEKSHIRISH (FIXED)
         fmt = d.get('fmt', 'pptx') # Default: pptx
         limit_key = f"free_{fmt}" if fmt in ['docx','pptx','pdf'] else "free_docx"
+        # Hajm va narx tugmadagi qiymatdan emas, server ro'yxati va narxlaridan olinadi (callback_data soxtalashtirilishi mumkin)
+        kind = "pptx" if fmt == "pptx" else "docx"
+        if pages not in DOC_LENGTHS['taqdimot' if kind == "pptx" else 'referat']:
+            return await c.message.answer("❌ Noto'g'ri hajm. Qaytadan boshlang.", reply_markup=main_kb)
+        cost = await get_price(f"{kind}_{pages}")
         
         is_free = u.get(limit_key, 0) > 0
         if not is_free and u['balance'] < cost:
             return await c.message.answer(f"❌ <b>Mablag' yetarli emas!</b>\nNarxi: {cost:,} so'm", parse_mode="HTML", reply_markup=main_kb)
+        if await queued_jobs_count() >= JOB_MAX_QUEUED:
+            return await c.message.answer("⏳ Hozir navbat juda katta. Birozdan so'ng qayta urinib ko'ring.", reply_markup=main_kb)
             
-        msg = await c.message.answer("⏳ <b>Qabul qilindi!</b>\nAI ishga tushdi...", parse_mode="HTML")
-        content = await generate_full_content(d['topic'], pages, d['dtype'], d['plan'], msg)
-        
-        if not content: return await msg.edit_text("❌ Xatolik. Qayta urinib ko'ring.")
-        
         info = {k: d.get(k, "-") for k in ['topic','student','uni','fac','grp','subj','teacher']}
         info['edu_place'] = d.get('uni', '-')
         info['direction'] = d.get('fac', '-')
         info['group'] = d.get('grp', '-')
         info['subject'] = d.get('subj', '-')
+        if fmt not in ("pptx", "pdf"): fmt = "docx"
         
-        # ANIQ FAYL YARATISH (FIXED)
-        if fmt == "pptx":
-            f = create_presentation(content, info, d.get('design', 'modern_blue'))
-            fn, cap = f"{d['topic'][:20]}.pptx", "✅ Slayd tayyor!"
-        elif fmt == "pdf":
-            f = create_pdf(content, info, d['dtype'])
-            fn, cap = f"{d['topic'][:20]}.pdf", "✅ PDF tayyor!"
-        else: # docx
-            f = create_document(content, info, d['dtype'])
-            fn, cap = f"{d['topic'][:20]}.docx", "✅ DOCX tayyor!"
-            
-        await c.message.answer_document(BufferedInputFile(f.read(), filename=fn), caption=cap, reply_markup=main_kb)
-        await msg.delete()
-        
-        if is_free: await update_limit(uid, limit_key, -1)
-        else: await update_balance(uid, -cost, "service_fee")
-        await add_full_hist(uid, d['dtype'], d['topic'], pages, info)
+        # Ish navbatga qo'yiladi, qolganini ishchi jarayon bajaradi
+        msg = await c.message.answer("⏳ <b>Qabul qilindi!</b>\nNavbatga qo'yildi...", parse_mode="HTML")
+        payload = {
+            "topic": d['topic'], "pages": pages, "dtype": d['dtype'], "plan": d.get('plan', '-'),
+            "fmt": fmt, "design": d.get('design', 'modern_blue'), "cost": cost, "limit_key": limit_key, "info": info,
+        }
+        pf = take_prefetch(uid, d['topic'], d['dtype'], d.get('plan', '-'))
+        if pf and pf.done(): payload['prefetched'] = prefetch_result(pf)
+        job_id = await enqueue_job(uid, c.message.chat.id, msg.message_id, payload, status='waiting' if pf and not pf.done() else 'queued')
+        if not job_id: # Boshqa ishlar balansni band qilib bo'lgan
+            if pf: pf.cancel()
+            await msg.edit_text(f"❌ <b>Mablag' yetarli emas!</b>\nNarxi: {cost:,} so'm", parse_mode="HTML")
+        elif pf and not pf.done():
+            task = asyncio.create_task(release_after_prefetch(job_id, pf))
+            background_tasks.add(task); task.add_done_callback(background_tasks.discard)
         
     except Exception as e:
-        print(f"ERR: {e}")
+        report_error("handler", f"Order error: {e}")
         await c.message.answer(f"Texnik xatolik: {e}", reply_markup=main_kb)
     await state.clear()
 
 # --- ADMIN PANEL PRO (BLOCKING ADDED) ---
 async def show_admin_main(m: types.Message):
     kb = InlineKeyboardBuilder()
+    kb.button(text="📈 Statistika", callback_data="adm_stats")
     kb.button(text="📊 Hisobot (Log)", callback_data="adm_full_log")
     kb.button(text="📢 Hammaga Xabar", callback_data="adm_bc")
     kb.button(text="👤 Xabar (ID orqali)", callback_data="adm_send_one")
@@ -652,19 +1930,86 @@ async def admin_cmd(m: types.Message):
 async def back_to_admin(c: CallbackQuery):
     await c.message.delete(); await show_admin_main(c.message)
 
+def format_stats(totals, daily):
+    n = lambda v: f"{abs(v or 0):,}"
+    rows = {(r['metric'], r['dim']): r for r in totals}
+    line = lambda r: f"{n(r['d1'])} / {n(r['d7'])} / {n(r['d30'])}"
+    txt = "📈 <b>STATISTIKA</b>\n<i>bugun / 7 kun / 30 kun</i>\n\n🧾 <b>Buyurtmalar:</b>\n"
+    txt += "".join(f"▫️ {dim}: {line(r)}\n" for (metric, dim), r in rows.items() if metric == 'orders') or "▫️ -\n"
+    money = {"deposit": "Kirim", "service_fee": "Xizmatlar", "referral_bonus": "Referal bonus"}
+    txt += "\n💰 <b>Pul (so'm):</b>\n" + "".join(f"▫️ {money.get(dim, dim)}: {line(r)}\n" for (metric, dim), r in rows.items() if metric == 'money')
+    txt += "\n🎁 <b>Bepul / pullik:</b>\n" + "".join(f"▫️ {'Bepul' if dim == 'free' else 'Pullik'}: {line(r)}\n" for (metric, dim), r in rows.items() if metric == 'usage')
+    txt += "\n👥 <b>Referal:</b>\n" + "".join(f"▫️ {'Kelganlar' if dim == 'signup' else 'Birinchi buyurtma'}: {line(r)}\n" for (metric, dim), r in rows.items() if metric == 'referrals')
+    jobs = {dim: r for (metric, dim), r in rows.items() if metric == 'jobs'}
+    txt += "\n🤖 <b>Ishlar:</b>\n" + "".join(f"▫️ {dim}: {line(r)}\n" for dim, r in jobs.items())
+    # To'liq yozilgan ishlar ulushi: reja chiqmagan ('llm') va bo'limi yozilmagan ('partial') ishlar muvaffaqiyatsiz
+    for k, label in (('d7', '7 kun'), ('d30', '30 kun')):
+        done = (jobs['done'][k] or 0) if 'done' in jobs else 0
+        fail = sum((jobs[d][k] or 0) for d in ('llm', 'partial') if d in jobs)
+        if done + fail: txt += f"▫️ AI muvaffaqiyati ({label}): {done * 100 / (done + fail):.1f}%\n"
+    txt += "\n📅 <b>Oxirgi 7 kun:</b>\n" + "".join(f"▫️ {r['day']:%m-%d}: {r['n']:,} ta\n" for r in daily)
+    return txt
+
+@router.callback_query(F.data.in_(["adm_stats", "adm_stats_refresh"]))
+async def adm_stats(c: CallbackQuery):
+    if not await is_admin(c.from_user.id): return
+    if c.data == "adm_stats_refresh": await refresh_stats()
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🔄 Yangilash", callback_data="adm_stats_refresh")
+    kb.button(text="🔙 Orqaga", callback_data="admin_home")
+    kb.adjust(2)
+    txt = format_stats(*await get_stats())
+    if c.data == "adm_stats_refresh":
+        try: await c.message.edit_text(txt, parse_mode="HTML", reply_markup=kb.as_markup())
+        except TelegramBadRequest: pass # O'zgarish yo'q
+        return await c.answer("✅ Yangilandi")
+    await c.message.delete()
+    await c.message.answer(txt, parse_mode="HTML", reply_markup=kb.as_markup())
+
 @router.callback_query(F.data == "adm_full_log")
+async def adm_log_menu(c: CallbackQuery):
+    if not await is_admin(c.from_user.id): return
+    await c.message.delete()
+    await c.message.answer("📊 <b>HISOBOT</b>\nDavrni tanlang:", parse_mode="HTML", reply_markup=export_period_kb())
+
+@router.callback_query(F.data == "logp_range")
+async def adm_log_range(c: CallbackQuery, state: FSMContext):
+    if not await is_admin(c.from_user.id): return
+    await c.message.delete()
+    await c.message.answer("🗓 Sana oralig'ini yozing:\n<code>2024-01-01 2024-01-31</code>", parse_mode="HTML", reply_markup=cancel_kb)
+    await state.set_state(AdminState.log_range)
+
+@router.message(AdminState.log_range)
+async def adm_log_range_get(m: types.Message, state: FSMContext):
+    if not await is_admin(m.from_user.id): return await state.clear()
+    try: date_from, date_to = [datetime.strptime(x, "%Y-%m-%d").strftime("%Y%m%d") for x in m.text.split()]
+    except Exception: return await m.answer("❌ Format: <code>2024-01-01 2024-01-31</code>", parse_mode="HTML")
+    await state.clear()
+    await m.answer("✅ Qabul qilindi.", reply_markup=main_kb)
+    await m.answer("📄 Hujjat turini tanlang:", reply_markup=export_type_kb(date_from, date_to))
+
+@router.callback_query(F.data.startswith("logp_"))
+async def adm_log_type(c: CallbackQuery):
+    if not await is_admin(c.from_user.id): return
+    _, date_from, date_to = c.data.split("_")
+    await c.message.edit_text("📄 Hujjat turini tanlang:", reply_markup=export_type_kb(date_from, date_to))
+
+@router.callback_query(F.data.startswith("logx_"))
 async def adm_log_dl(c: CallbackQuery):
-    await c.message.answer("⏳ Yuklanmoqda...")
-    async with pool.acquire() as conn:
-        data = await conn.fetch("""
-            SELECT h.date, u.full_name, u.username, u.user_id, h.doc_type, h.topic, h.student, h.uni, h.faculty, h.grp, h.teacher 
-            FROM history h JOIN users u ON h.user_id = u.user_id ORDER BY h.id DESC LIMIT 1000
-        """)
-    output = StringIO(); writer = csv.writer(output)
-    writer.writerow(["Sana", "Foydalanuvchi", "Username", "ID", "Turi", "Mavzu", "Talaba", "Universitet", "Fakultet", "Guruh", "O'qituvchi"])
-    for r in data: writer.writerow(list(r.values()))
-    output.seek(0)
-    await c.message.answer_document(BufferedInputFile(output.getvalue().encode(), filename="FULL_REPORT.csv"))
+    # Butun tarix (ism, universitet, guruh) - faqat adminlarga
+    if not await is_admin(c.from_user.id): return
+    _, date_from, date_to, dtype = c.data.split("_")
+    await c.message.edit_text("⏳ Yuklanmoqda...")
+    day = lambda x: datetime.strptime(x, "%Y%m%d").date() if x != "0" else None
+    try:
+        f, rows = await export_history(day(date_from), day(date_to), None if dtype == "all" else dtype)
+    except Exception as e:
+        report_error("export", f"Export error: {e}")
+        return await c.message.edit_text(f"❌ Xatolik: {e}")
+    with f:
+        period = "hammasi" if date_from == "0" else f"{date_from}-{date_to if date_to != '0' else 'bugun'}"
+        await c.message.answer_document(SpooledInputFile(f, f"REPORT_{period}_{dtype}.csv.gz"), caption=f"📊 {rows:,} ta yozuv")
+    await c.message.delete()
 
 @router.callback_query(F.data == "adm_prices")
 async def adm_prices_ui(c: CallbackQuery):
@@ -707,15 +2052,19 @@ async def adm_bc_ui(c: CallbackQuery, state: FSMContext):
 
 @router.message(AdminState.bc_msg)
 async def adm_bc_send(m: types.Message, state: FSMContext):
-    await m.answer("🚀 Yuborilmoqda...")
-    async with pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-        cnt = 0
-        for u in users:
-            try: await m.copy_to(u['user_id']); cnt+=1; await asyncio.sleep(0.05)
-            except: pass
-    await m.answer(f"✅ Xabar <b>{cnt}</b> ta foydalanuvchiga yuborildi.", parse_mode="HTML", reply_markup=main_kb)
     await state.clear()
+    bc_id = await create_broadcast(m.from_user.id, m.chat.id, m.message_id)
+    kb = InlineKeyboardBuilder(); kb.button(text="⏹ To'xtatish", callback_data=f"bc_stop_{bc_id}")
+    report = await m.answer("🚀 Yuborilmoqda...", reply_markup=kb.as_markup())
+    async with pool.acquire() as conn: await conn.execute("UPDATE broadcasts SET report_msg_id=$2 WHERE id=$1", bc_id, report.message_id)
+    await m.answer("ℹ️ Tarqatish fonda davom etadi, hisobot shu yerda yangilanadi.", reply_markup=main_kb)
+    await resume_broadcasts(m.bot)
+
+@router.callback_query(F.data.startswith("bc_stop_"))
+async def adm_bc_stop(c: CallbackQuery):
+    if not await is_admin(c.from_user.id): return
+    await stop_broadcast(int(c.data.split("_")[2]))
+    await c.answer("⏹ To'xtatilmoqda...")
 
 @router.callback_query(F.data == "adm_send_one")
 async def adm_send_one_ui(c: CallbackQuery, state: FSMContext):
@@ -817,7 +2166,7 @@ async def pay_init(c: CallbackQuery, state: FSMContext):
         await c.message.edit_reply_markup(reply_markup=kb.as_markup())
         
     except Exception as e:
-        print(f"Pay Init Error: {e}")
+        report_error("handler", f"Pay Init Error: {e}")
 
 # 3. Chekni (Rasmni) qabul qilish va Adminga yuborish
 @router.message(PayState.screenshot, F.photo)
@@ -836,8 +2185,7 @@ async def pay_check_photo(m: types.Message, state: FSMContext):
     admins = await get_admins()
     if ADMIN_ID not in admins: admins.append(ADMIN_ID) # Asosiy adminni qo'shish
     
-    sent_count = 0
-    for admin_id in admins:
+    async def send_to(admin_id):
         try:
             await m.bot.send_photo(
                 chat_id=admin_id,
@@ -852,9 +2200,13 @@ async def pay_check_photo(m: types.Message, state: FSMContext):
                 parse_mode="HTML",
                 reply_markup=kb.as_markup()
             )
-            sent_count += 1
+            return True
         except Exception as e:
-            print(f"Admin send error: {e}")
+            report_error("handler", f"Admin send error: {e}")
+            return False
+
+    # Barcha adminlarga bir vaqtda (limitlarni SendScheduler kuzatadi)
+    sent_count = sum(await asyncio.gather(*(send_to(a) for a in admins)))
 
     if sent_count > 0:
         await m.answer("✅ <b>Chek yuborildi!</b>\nAdminlar tekshirib, tez orada hisobingizni to'ldirishadi.", parse_mode="HTML", reply_markup=main_kb)
@@ -908,24 +2260,390 @@ async def deny_pay(c: CallbackQuery):
             parse_mode="HTML"
         )
         await c.bot.send_message(uid, "❌ <b>To'lovingiz rad etildi.</b>\nChek noto'g'ri yoki xira bo'lishi mumkin.", parse_mode="HTML")
-    except: pass
+    except Exception as e: report_error("handler", f"Deny error: {e}")
         
 @router.callback_query(F.data == "close")
 async def close_cb(c: CallbackQuery): await c.message.delete()
 @router.message(F.text == "❌ Bekor qilish")
 async def cancel_all(m: types.Message, state: FSMContext): await state.clear(); await m.answer("Bekor qilindi.", reply_markup=main_kb)
 
+# ==============================================================================
+# ISHCHILAR (NAVBATDAGI ISHLARNI BAJARISH)
+# ==============================================================================
+class StatusMessage:
+    # Ishchi jarayonda "Jarayon: N%" xabarini id orqali tahrirlash uchun
+    def __init__(self, bot, chat_id, message_id):
+        self.bot, self.chat_id, self.message_id = bot, chat_id, message_id
+
+    async def edit_text(self, text, **kw):
+        return await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kw)
+
+    async def show(self, text):
+        # Ish davomidagi xabar: xato bo'lsa ham ish to'xtamaydi
+        try: await self.edit_text(text, parse_mode="HTML")
+        except TelegramAPIError as e: print(f"Status edit error: {e}")
+
+    async def delete(self):
+        try: await self.bot.delete_message(self.chat_id, self.message_id)
+        except TelegramBadRequest: pass
+
+async def process_job(bot, job):
+    p, uid, chat_id = job['payload'], job['user_id'], job['chat_id']
+    status = StatusMessage(bot, chat_id, job['status_msg_id'])
+    fmt, info = p['fmt'], p['info']
+    # Narx navbatga qo'yilganda band qilingan: bu yerda balans tekshirilmaydi
+    
+    # Hujjat bo'limlar yozilayotganda yig'iladi (keshdan kelsa - odatdagidek bir martada)
+    stream = RenderStream(fmt, info, p['design'], p['dtype']) if RENDER_STREAM else None
+    path = None
+    fn, cap = f"{p['topic'][:20]}.{fmt}", {"pptx": "✅ Slayd tayyor!", "pdf": "✅ PDF tayyor!", "docx": "✅ DOCX tayyor!"}[fmt]
+    try:
+        with JOB_STAGE_SECONDS.labels("content", fmt).time():
+            content = await get_content(p['topic'], p['pages'], p['dtype'], p['plan'], status, p.get('prefetched'), stream)
+        if not content:
+            await status.show("❌ Xatolik. Qayta urinib ko'ring.")
+            return await finish_job(job['id'], 'failed', 'llm')
+
+        # Xuddi shu hujjat avval yuborilgan bo'lsa - yasash va yuklashsiz, file_id bilan qayta yuboriladi
+        key = document_key(fmt, p['design'], p['dtype'], info, content)
+        if await send_known_file(bot, chat_id, key, cap): job['delivered'] = True
+        else:
+            await status.show("⏳ <b>Jarayon: 97%</b>\n\n⚙️ Fayl tayyorlanmoqda...")
+            with JOB_STAGE_SECONDS.labels("render", fmt).time():
+                path = await stream.result() if stream else None
+                if not path: path = await render_async(fmt, content, info, p['design'], p['dtype'])
+            if not path:
+                await status.show("❌ Faylni yaratib bo'lmadi. Qayta urinib ko'ring.")
+                return await finish_job(job['id'], 'failed', 'render')
+
+            with JOB_STAGE_SECONDS.labels("send", fmt).time():
+                msg = await bot.send_document(chat_id, FSInputFile(path, filename=fn), caption=cap, reply_markup=main_kb)
+            job['delivered'] = True # Shundan keyin ish "failed" bo'lmaydi va qayta navbatga qo'yilmaydi
+            if msg.document:
+                try: await sent_file_store(key, fmt, msg.document)
+                except Exception as e: report_error("db", f"Sent file error: {e}")
+    finally:
+        if stream: stream.abort()
+        if path: remove_render_file(path)
+
+    # Fayl yetkazildi: keyingi qadamlar xatosi faqat qayd etiladi (user "Texnik xatolik" yoki faylni ikkinchi marta olmaydi).
+    # Yozilmay qolgan bo'lim bo'lsa ish yuboriladi, lekin statistikada LLM xatosi sifatida sanaladi
+    try:
+        await asyncio.shield(finish_job(job['id'], 'done', 'partial' if any(x['content'] == "..." for x in content) else None))
+        await status.delete()
+        await add_full_hist(uid, p['dtype'], p['topic'], p['pages'], info, fmt)
+    except Exception as e: report_error("job", f"Job {job['id']} after delivery: {e}")
+
+async def send_known_file(bot, chat_id, key, caption):
+    try: file_id = await sent_file_lookup(key)
+    except Exception as e:
+        report_error("db", f"Sent file error: {e}"); return False
+    if not file_id:
+        FILE_REUSE.labels("miss").inc(); return False
+    try: await bot.send_document(chat_id, file_id, caption=caption, reply_markup=main_kb)
+    except TelegramBadRequest as e: # file_id yaroqsiz bo'lib qolgan: fayl qaytadan yasaladi
+        FILE_REUSE.labels("stale").inc(); print(f"file_id error: {e}")
+        await sent_file_forget(key); return False
+    FILE_REUSE.labels("hit").inc()
+    return True
+
+async def run_job(bot, job):
+    job = dict(job) # process_job yetkazilganini belgilaydi ('delivered')
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(JOB_STALE_SECONDS / 3)
+            await touch_job(job['id'])
+    hb = asyncio.create_task(heartbeat())
+    active_jobs.add(job['id'])
+    # Navbatda kutish: buyurtma berilgandan ishchi olguncha (claim_job updated_at ni yangilaydi)
+    JOB_STAGE_SECONDS.labels("queue", job['payload']['fmt']).observe((job['updated_at'] - job['created_at']).total_seconds())
+    try:
+        await process_job(bot, job)
+    except asyncio.CancelledError:
+        # Jarayon to'xtatilyapti: yetkazilmagan ish boshqa ishchiga qaytariladi
+        if not job.get('delivered'): await asyncio.shield(finish_job(job['id'], 'queued'))
+        raise
+    except Exception as e:
+        report_error("job", f"Job {job['id']} error: {e}")
+        if job.get('delivered'): return # Fayl userda: holat o'zgartirilmaydi
+        await finish_job(job['id'], 'failed', str(e))
+        try: await bot.send_message(job['chat_id'], f"Texnik xatolik: {e}", reply_markup=main_kb)
+        except Exception: pass
+    finally:
+        hb.cancel(); active_jobs.discard(job['id'])
+
+jobs_event = asyncio.Event()
+background_tasks = set()
+active_jobs = set() # Shu jarayonda bajarilayotgan ishlar (health-check, metrikalar)
+
+def on_settings_changed(*_):
+    task = asyncio.get_running_loop().create_task(load_settings())
+    background_tasks.add(task); task.add_done_callback(background_tasks.discard)
+
+async def listen(channels):
+    # LISTEN/NOTIFY uchun alohida ulanish: yangi ishlar, sozlamalar o'zgarishi
+    try:
+        conn = await asyncpg.connect(DATABASE_URL)
+        for channel, callback in channels.items(): await conn.add_listener(channel, callback)
+        return conn
+    except Exception as e:
+        report_error("db", f"LISTEN error: {e}")
+
+async def job_worker(bot):
+    while True:
+        if render_busy(): # Render navbati to'la: yangi ish olmaymiz
+            await asyncio.sleep(1); continue
+        try: job = await claim_job()
+        except Exception as e:
+            report_error("db", f"Claim error: {e}"); job = None
+        if job:
+            await run_job(bot, job); continue
+        jobs_event.clear()
+        try: await asyncio.wait_for(jobs_event.wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError: pass
+
+async def maintenance_loop(bot):
+    while True:
+        try:
+            if await requeue_stale_jobs(): jobs_event.set()
+            await prune_content_cache()
+            prune_render_files()
+            await prune_fsm_states()
+            await resume_broadcasts(bot)
+            await load_settings() # LISTEN ulanishi uzilgan bo'lsa ham kesh eskirib qolmaydi
+            await refresh_stats()
+        except Exception as e: report_error("maintenance", f"Maintenance error: {e}")
+        await asyncio.sleep(JOB_STALE_SECONDS / 2)
+
+async def start_job_workers(bot, n):
+    global stream_workers
+    channels = {'settings_changed': on_settings_changed, 'user_changed': lambda conn, pid, ch, uid: forget_user(int(uid))}
+    if n: channels['jobs_new'] = lambda *_: jobs_event.set()
+    listener = await listen(channels)
+    # LLM klienti (oldindan yozish va ishlar uchun) fonda yuklanadi: event loop to'xtab qolmaydi
+    if llm_slots: asyncio.get_running_loop().run_in_executor(None, load_llm)
+    if n and RENDER_STREAM: # Oqimli yig'ish pooli ishchilar soniga teng, fonda ochiladi
+        stream_workers = n; start_stream_pool()
+    if n and not os.path.exists(FONT_PATH): print(f"⚠️ PDF shrifti topilmadi ({FONT_PATH}): python main.py fetch-font yoki FONT_PATH")
+    tasks = [asyncio.create_task(job_worker(bot)) for _ in range(n)]
+    tasks.append(asyncio.create_task(maintenance_loop(bot)))
+    return tasks, listener
+
+async def stop_job_workers(tasks, listener):
+    for t in tasks: t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if listener: await listener.close()
+
+# ==============================================================================
+# TARQATISH (BROADCAST) - FONDA, DAVOM ETTIRILADIGAN
+# ==============================================================================
+broadcast_tasks = {}
+
+def broadcast_report(bc, final=False):
+    head = "✅ <b>Tarqatish yakunlandi</b>" if final else "🚀 <b>Yuborilmoqda...</b>"
+    if bc['status'] == 'cancelled': head = "⏹ <b>Tarqatish to'xtatildi</b>"
+    done = bc['sent'] + bc['failed'] + bc['blocked']
+    return (f"{head} (#{bc['id']})\n\n📨 Yuborildi: <b>{bc['sent']}</b>\n🚫 Botni bloklagan: {bc['blocked']}\n"
+            f"⚠️ Xato: {bc['failed']}\n📊 {done}/{bc['total']}")
+
+async def run_broadcast(bot, bc):
+    send_priority.set(PRIO_BULK) # Oddiy foydalanuvchilarga javoblar kutib qolmaydi
+    bc_id, owner, last_uid = bc['id'], bc['owner'], bc['last_uid']
+    sem = asyncio.Semaphore(BC_CONCURRENCY)
+    last_report = 0
+
+    async def send_one(uid):
+        async with sem:
+            try:
+                await bot.copy_message(chat_id=uid, from_chat_id=bc['from_chat_id'], message_id=bc['message_id']); return "sent"
+            except TelegramForbiddenError: return "blocked"
+            except TelegramAPIError as e:
+                print(f"Broadcast {bc_id} -> {uid}: {e}"); return "failed"
+
+    async def report(row, final=False):
+        if not row['report_msg_id']: return
+        kb = None
+        if not final:
+            b = InlineKeyboardBuilder(); b.button(text="⏹ To'xtatish", callback_data=f"bc_stop_{bc_id}"); kb = b.as_markup()
+        try: await bot.edit_message_text(broadcast_report(row, final), chat_id=row['admin_id'], message_id=row['report_msg_id'], parse_mode="HTML", reply_markup=kb)
+        except TelegramAPIError as e: print(f"Broadcast report error: {e}")
+
+    try:
+        while True:
+            uids = await broadcast_batch(last_uid)
+            if not uids:
+                await finish_broadcast(bc_id, owner, 'done'); break
+            res = await asyncio.gather(*(send_one(u) for u in uids))
+            last_uid = uids[-1]
+            row = await save_broadcast_progress(bc_id, owner, last_uid, res.count("sent"), res.count("failed"), [u for u, r in zip(uids, res) if r == "blocked"])
+            if row is None or row['status'] != 'running': break # Boshqa jarayon oldi yoki admin to'xtatdi
+            if time.monotonic() - last_report > BC_REPORT_INTERVAL:
+                await report(row); last_report = time.monotonic()
+        async with pool.acquire() as conn: row = await conn.fetchrow("SELECT * FROM broadcasts WHERE id=$1", bc_id)
+        if row['owner'] == owner: await report(row, final=True)
+    except Exception as e:
+        report_error("broadcast", f"Broadcast {bc_id} error: {e}") # Lease tugagach boshqa jarayon davom ettiradi
+    finally:
+        broadcast_tasks.pop(bc_id, None)
+
+async def resume_broadcasts(bot):
+    owner = f"{os.getpid()}-{random.getrandbits(32):x}"
+    for bc in await claim_broadcasts(owner, list(broadcast_tasks)):
+        broadcast_tasks[bc['id']] = asyncio.create_task(run_broadcast(bot, bc))
+
+async def run_worker():
+    # Alohida ishchi: python main.py worker
+    await init_db()
+    bot = make_bot()
+    tasks, listener = await start_job_workers(bot, max(JOB_WORKERS, 1))
+    if METRICS_PORT: # /metrics va health-check (webhook qabul qilinmaydi)
+        tasks.append(asyncio.create_task(run_web_server(METRICS_PORT, lifespan="off")))
+    print(f"🛠 Ishchi ishga tushdi ({max(JOB_WORKERS, 1)} ta)")
+    try: await asyncio.gather(*tasks)
+    finally:
+        await stop_job_workers(tasks, listener)
+        await close_llm_clients(); shutdown_render_pool(); await bot.session.close()
+
+# ==============================================================================
+# FSM SAQLASH (POSTGRES + JARAYON ICHIDAGI KESH)
+# ==============================================================================
+class PgStorage(BaseStorage):
+    # Anketa holatlari jarayon qayta ishga tushsa ham yo'qolmaydi va jarayonlar orasida bo'linadi.
+    # Yozish to'g'ridan-to'g'ri bazaga ketadi, o'qish FSM_CACHE_TTL davomida keshdan olinadi.
+    def __init__(self):
+        self.cache = {} # key -> (muddati, state, data)
+
+    @staticmethod
+    def key_str(key):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+    def remember(self, k, state, data):
+        now = time.monotonic()
+        self.cache[k] = (now + FSM_CACHE_TTL, state, data)
+        if len(self.cache) > 20000: self.cache = {x: v for x, v in self.cache.items() if v[0] > now}
+
+    async def load(self, k):
+        hit = self.cache.get(k)
+        if hit and hit[0] > time.monotonic(): return hit[1], hit[2]
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT state, data FROM fsm_state WHERE key=$1", k)
+        state, data = (row['state'], row['data'] or {}) if row else (None, {})
+        self.remember(k, state, data)
+        return state, data
+
+    async def set_state(self, key, state=None):
+        k = self.key_str(key); state = state.state if isinstance(state, State) else state
+        async with pool.acquire() as conn:
+            if state is None:
+                row = await conn.fetchrow("UPDATE fsm_state SET state=NULL, updated_at=now() WHERE key=$1 RETURNING data", k)
+            else:
+                row = await conn.fetchrow("""
+                    INSERT INTO fsm_state (key, state) VALUES ($1, $2)
+                    ON CONFLICT (key) DO UPDATE SET state=$2, updated_at=now() RETURNING data
+                """, k, state)
+        self.remember(k, state, row['data'] if row else {})
+
+    async def set_data(self, key, data):
+        k = self.key_str(key); data = dict(data)
+        async with pool.acquire() as conn:
+            if data:
+                row = await conn.fetchrow("""
+                    INSERT INTO fsm_state (key, data) VALUES ($1, $2)
+                    ON CONFLICT (key) DO UPDATE SET data=$2, updated_at=now() RETURNING state
+                """, k, data)
+            else: # Bo'sh qator saqlanmaydi
+                await conn.execute("DELETE FROM fsm_state WHERE key=$1 AND state IS NULL", k)
+                row = await conn.fetchrow("UPDATE fsm_state SET data='{}', updated_at=now() WHERE key=$1 RETURNING state", k)
+        self.remember(k, row['state'] if row else None, data)
+
+    async def update_data(self, key, data):
+        # Bitta so'rovda birlashtirish (jsonb ||)
+        k = self.key_str(key)
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                INSERT INTO fsm_state (key, data) VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE SET data = fsm_state.data || $2, updated_at=now() RETURNING state, data
+            """, k, dict(data))
+        self.remember(k, row['state'], row['data'])
+        return dict(row['data'])
+
+    async def get_state(self, key):
+        return (await self.load(self.key_str(key)))[0]
+
+    async def get_data(self, key):
+        return dict((await self.load(self.key_str(key)))[1])
+
+    async def close(self):
+        self.cache.clear()
+
+async def prune_fsm_states():
+    async with pool.acquire() as conn:
+        await conn.execute("DELETE FROM fsm_state WHERE updated_at < now() - make_interval(secs => $1)", FSM_STATE_TTL_HOURS * 3600)
+
+def make_dispatcher():
+    dp = Dispatcher(storage=PgStorage() if pool else MemoryStorage())
+    dp.include_router(router)
+    return dp
+
+# --- WEBHOOK REJIMI (uvicorn, bir nechta jarayon) ---
+async def update_consumer(bot, dp):
+    while True:
+        data = await update_queue.get()
+        try: await dp.feed_update(bot, types.Update.model_validate(data, context={"bot": bot}))
+        except Exception as e: report_error("update", f"Update error: {e}")
+        finally: update_queue.task_done()
+
+async def start_webhook_runtime():
+    # Har bir uvicorn jarayonida ishga tushadi
+    await init_db()
+    bot, dp = make_bot(), make_dispatcher()
+    consumers = [asyncio.create_task(update_consumer(bot, dp)) for _ in range(UPDATE_CONSUMERS)]
+    tasks, listener = await start_job_workers(bot, JOB_WORKERS)
+    webhook_runtime.update(bot=bot, dp=dp, consumers=consumers, tasks=tasks, listener=listener)
+    print(f"🚀 Webhook jarayoni tayyor (pid {os.getpid()})")
+
+async def stop_webhook_runtime():
+    rt = webhook_runtime; dp = rt.pop("dp", None)
+    if dp is None: return
+    # Navbatda qolgan yangilanishlarga biroz vaqt beramiz
+    try: await asyncio.wait_for(update_queue.join(), 10)
+    except asyncio.TimeoutError: print(f"⚠️ {update_queue.qsize()} ta yangilanish qayta ishlanmadi")
+    for t in rt["consumers"]: t.cancel()
+    await stop_job_workers(rt["tasks"], rt["listener"])
+    await close_llm_clients(); shutdown_render_pool(); await rt["bot"].session.close()
+
+async def setup_webhook():
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        sys.exit("WEBHOOK_URL va WEBHOOK_SECRET o'rnatilishi shart (BOT_MODE=webhook)")
+    bot = make_bot()
+    try:
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=router.resolve_used_update_types())
+    finally: await bot.session.close()
+
+def run_webhook():
+    asyncio.run(setup_webhook())
+    print(f"🚀 PRO Bot webhook rejimida ({WEB_WORKERS} ta jarayon)")
+    uvicorn.run("main:app", host="0.0.0.0", port=int(os.environ.get("PORT", 8000)), workers=WEB_WORKERS, log_level="error")
+
 async def main():
     await init_db()
     asyncio.create_task(run_web_server())
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
-    dp.include_router(router)
+    bot = make_bot()
+    dp = make_dispatcher()
     await bot.delete_webhook(drop_pending_updates=True)
+    tasks, listener = await start_job_workers(bot, JOB_WORKERS)
     print("🚀 PRO Bot ishga tushdi!")
-    await dp.start_polling(bot)
+    try: await dp.start_polling(bot)
+    finally:
+        await stop_job_workers(tasks, listener)
+        await close_llm_clients(); shutdown_render_pool()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-    try: asyncio.run(main())
-    except: pass
+    try:
+        if "fetch-font" in sys.argv[1:]: fetch_font()
+        elif "worker" in sys.argv[1:]: asyncio.run(run_worker())
+        elif BOT_MODE == "webhook": run_webhook()
+        else: asyncio.run(main())
+    except KeyboardInterrupt: pass